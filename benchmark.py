@@ -0,0 +1,288 @@
+# POSTCODE FINDER BENCHMARKS
+# AUTHOR: Pascal Philipp
+
+# Runs representative searches against deterministic fake routing backends,
+# which derive travel times from the as-the-crow-flies distance, so that the
+# benchmarks work offline and give the same results on every run. The
+# timings of the stages of the search pipeline, the number of routing calls
+# and the peak memory are printed and appended to a results file, together
+# with the current git commit, to compare runs across commits.
+#
+# Usage: python benchmark.py [--cases sample,...] [--compare]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+import tracemalloc
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+import postcode_finder as pf
+
+
+class FakeRoutingBackend(pf.RoutingBackend):
+    '''Routing backend computing travel times from the as-the-crow-flies
+    distance, with a detour factor, an average speed in km per minute and a
+    fixed overhead in minutes. The optional latency in seconds is added to
+    every request to emulate a routing server.
+    '''
+
+    def __init__(self, detour=1.3, speed=1.0, overhead=3, latency=0.0):
+        super().__init__()
+        self.detour = detour
+        self.speed = speed
+        self.overhead = overhead
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0  # number of requests made
+        self.pairs = 0  # number of travel times requested
+
+    def minutes(self, orig_lat, orig_lon, dest_lat, dest_lon):
+        '''Return the fake travel time in minutes between two points.'''
+        dist = pf.PostcodeFinder.compute_distance(orig_lat, orig_lon,
+                                                  dest_lat, dest_lon)
+        return int(round(dist * self.detour / self.speed)) + self.overhead
+
+    def count(self, pairs):
+        '''Count one request for the given number of travel times.'''
+        with self.lock:
+            self.requests += 1
+            self.pairs += pairs
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def travel_time(self, orig_lat, orig_lon, dest_lat, dest_lon):
+        self.count(1)
+        return self.minutes(orig_lat, orig_lon, dest_lat, dest_lon)
+
+    def travel_time_matrix(self, origins, destinations, cancel=None):
+        chunk_size = self.matrix_chunk_size(len(destinations))
+        for k in range(0, len(origins), chunk_size):
+            self.count(len(origins[k:k+chunk_size]) * len(destinations))
+        return [[self.minutes(o[0], o[1], d[0], d[1]) for d in destinations]
+                for o in origins]
+
+
+class FakeOSRMServer(ThreadingMixIn, HTTPServer):
+    '''Local stand-in for an OSRM server, answering the route and table
+    services with the travel times of a FakeRoutingBackend. It's started on
+    a free port in a background thread, its URL is in the attribute url.
+    Tests can give a subclass of FakeOSRMHandler to change the answers.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, fake, handler=None):
+        super().__init__(('127.0.0.1', 0), handler or FakeOSRMHandler)
+        self.fake = fake
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeOSRMHandler(BaseHTTPRequestHandler):
+    '''Request handler of the FakeOSRMServer.'''
+
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+    disable_nagle_algorithm = True  # don't delay the small responses
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service, version, profile, coords = url.path.strip('/').split('/')
+        points = [tuple(float(x) for x in c.split(',')[::-1])
+                  for c in coords.split(';')]  # (lat, lon) tuples
+        data = self.answer(service, points, parse_qs(url.query))
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, service, points, query):
+        '''Return the JSON data answering a request to the given service
+        with the given points ((lat, lon) tuples) and query parameters.
+        '''
+        fake = self.server.fake
+        if service == 'route':
+            fake.count(1)
+            minutes = fake.minutes(*(points[0] + points[1]))
+            return {'code': 'Ok', 'routes': [{'duration': minutes * 60}]}
+        sources = [int(i) for i in query['sources'][0].split(';')]
+        dests = [int(i) for i in query['destinations'][0].split(';')]
+        fake.count(len(sources) * len(dests))
+        return {'code': 'Ok',
+                'durations': [[fake.minutes(*(points[i] + points[j])) * 60
+                               for j in dests] for i in sources]}
+
+    def log_message(self, format, *args):
+        pass  # no logging of every request
+
+
+# representative searches: destination distances and max speed
+cases = {
+    'sample': ({'EX1': 40, 'TA1': 35}, 1.2),
+    'three_destinations': ({'B1': 60, 'CV1': 60, 'LE1': 60}, 1.2),
+    'large_three_destinations': ({'M1': 90, 'LS1': 90, 'S1': 90}, 1.2),
+}
+
+# ways to run a search: backend ('fake' in process or 'http' through the
+# fake OSRM server), matrix mode and number of workers
+modes = {
+    'pairs': ('fake', False, 1),
+    'pairs_parallel': ('fake', False, 8),
+    'matrix': ('fake', True, 1),
+    'http_pairs_parallel': ('http', False, 8),
+    'http_matrix': ('http', True, 1),
+}
+
+results_file = 'benchmark_results.jsonl'
+
+
+class MapSettings():
+    '''Stand-in for the check buttons of the application.'''
+
+    class Value():
+        def get(self):
+            return 1
+
+    draw_search_area_CB_value = Value()
+    pc_labels_CB_value = Value()
+
+
+def run_case(name, mode, latency, with_map):
+    '''Run one search and return dictionary of its measurements.'''
+    destination_distances, max_speed = cases[name]
+    backend_name, matrix, workers = modes[mode]
+    fake = FakeRoutingBackend(latency=latency)
+    timings = {}
+    tracemalloc.start()
+    with contextlib.ExitStack() as stack:
+        if backend_name == 'http':
+            server = stack.enter_context(FakeOSRMServer(fake))
+            backend = pf.OSRMBackend(server.url, pool_size=workers)
+        else:
+            backend = fake
+        # the output of the search is not part of the benchmark
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        t = time.perf_counter()
+        pcf = pf.PostcodeFinder(destination_distances, max_speed)
+        timings['set_up'] = time.perf_counter() - t
+        candidates = len(pcf.pc)
+        t = time.perf_counter()
+
+        def on_result(p, times):
+            if 'first_result' not in timings:
+                timings['first_result'] = time.perf_counter() - t
+
+        pcf.pcf_main(backend, matrix, workers, on_result=on_result)
+        timings['search'] = time.perf_counter() - t
+        if with_map and len(pcf.pc) > 0:
+            t = time.perf_counter()
+            pf.PostcodeVisualiser(pcf).vis_main(MapSettings())
+            timings['map'] = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'case': name, 'mode': mode, 'timings': timings,
+            'candidates': candidates, 'found': len(pcf.pc),
+            'routing_requests': fake.requests, 'routing_pairs': fake.pairs,
+            'routing_calls_avoided': pcf.routing_calls_avoided,
+            'peak_memory': peak}
+
+
+def current_commit():
+    '''Return the hash of the current git commit, 'unknown' if not in git.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_previous(commit):
+    '''Return the last stored run of a commit other than the given one.'''
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['commit'] != commit:
+                    previous = run
+    return previous
+
+
+def print_result(result, previous):
+    '''Print the measurements of a search, compared to a previous run.'''
+    old = {}
+    if previous is not None:
+        for r in previous['results']:
+            if (r['case'], r['mode']) == (result['case'], result['mode']):
+                old = r
+    print('{} / {}: {} candidates, {} found'.format(
+        result['case'], result['mode'], result['candidates'],
+        result['found']))
+    for stage, seconds in sorted(result['timings'].items()):
+        line = '    {:<14}{:>10.4f} s'.format(stage, seconds)
+        if stage in old.get('timings', {}):
+            line += '  ({:+.1%})'.format(seconds / old['timings'][stage] - 1)
+        print(line)
+    print('    routing requests: {}, travel times: {}, avoided: {}'.format(
+        result['routing_requests'], result['routing_pairs'],
+        result['routing_calls_avoided']))
+    print('    peak memory: {:.1f} MB'.format(result['peak_memory'] / 2**20))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the search '
+                                     'pipeline with fake routing backends.')
+    parser.add_argument('--cases', default=','.join(cases),
+                        help='comma-separated cases to run')
+    parser.add_argument('--modes', default=','.join(modes),
+                        help='comma-separated modes to run')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='emulated latency of a routing request in s')
+    parser.add_argument('--map', action='store_true',
+                        help='also time the map (needs the shapefiles)')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the last run of another commit')
+    parser.add_argument('--no-save', action='store_true',
+                        help="don't append the results to " + results_file)
+    args = parser.parse_args(argv)
+    commit = current_commit()
+    previous = load_previous(commit) if args.compare else None
+    if previous is not None:
+        print('Comparing with commit', previous['commit'])
+    # loading the table of postcodes is a stage of its own
+    t = time.perf_counter()
+    pf.get_pc_raw()
+    print('load_table: {:.4f} s'.format(time.perf_counter() - t))
+    results = []
+    for name in args.cases.split(','):
+        for mode in args.modes.split(','):
+            result = run_case(name, mode, args.latency, args.map)
+            print_result(result, previous)
+            results.append(result)
+    if not args.no_save:
+        with open(results_file, 'a') as f:
+            f.write(json.dumps({'commit': commit, 'time': time.time(),
+                                'latency': args.latency,
+                                'results': results}) + '\n')
+        print('Results appended to', results_file)
+
+
+if __name__ == '__main__':
+    main()
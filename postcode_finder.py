@@ -1,19 +1,30 @@
 # POSTCODE FINDER
 # AUTHOR: Pascal Philipp
 
+# The module can be imported without side effects, e.g. to use the
+# PostcodeFinder in batch jobs. The heavy dependencies requests, selenium,
+# geopandas, shapely and matplotlib are only imported where they are used,
+# i.e. by the routing backends and the visualisation. The application is in
+# the module postcode_finder_gui, which is only imported by run_gui(), so
+# that tkinter isn't needed on hosts without a display.
+
 import pandas as pd
 import numpy as np
+import os
 import time
-import pickle
+import struct
 import math
-import tkinter as tk
-import tkinter.scrolledtext as tkst
-from selenium import webdriver
-import geopandas
-from shapely.geometry import Point
-from matplotlib.patches import Rectangle
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib import pyplot as plt
+import json
+import bisect
+import sqlite3
+import argparse
+import threading
+import queue
+import collections
+import contextlib
+import socket
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
 
 
 class SearchAreaError(Exception):
@@ -25,16 +36,1134 @@ class SearchAreaError(Exception):
         return repr(self.value)
 
 
-class PostcodeFinder():
+class RoutingBackend():
+    '''Interface of the routing engines that provide travel times.
 
-    def __init__(self, destination_distances, max_speed):
-        '''Set up the search for postcodes.'''
-        # dictionary of destination distances
-        self.destination_distances = destination_distances
+    Subclasses implement travel_time(), which returns the travel time by car
+    in minutes between two points, or -1 if no route could be found. The
+    methods open() and close() acquire and release resources such as browser
+    sessions or network connections; a backend can also be used as a context
+    manager. Backends can be used from several threads at once, requests
+    are limited to max_rate per second (no limit if None).
+    '''
+
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.rate_lock = threading.Lock()
+        self.next_request = 0.0  # earliest time of the next request
+
+    def throttle(self):
+        '''Wait until the next request is allowed by the rate limit.'''
+        if self.max_rate is None:
+            return
+        with self.rate_lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) \
+                + 1.0/self.max_rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def open(self):
+        '''Acquire the resources needed for routing.'''
+        pass
+
+    def close(self):
+        '''Release the resources acquired in open().'''
+        pass
+
+    def travel_time(self, orig_lat, orig_lon, dest_lat, dest_lon):
+        '''Return travel time in minutes by car, -1 if not found.'''
+        raise NotImplementedError
+
+    def matrix_chunk_size(self, n_destinations):
+        '''Return the number of origins per request of a travel time matrix
+        with the given number of destinations.
+        '''
+        return 100
+
+    def travel_time_matrix(self, origins, destinations, cancel=None):
+        '''Return travel times in minutes from each origin to each
+        destination as a list of rows, one row per origin. Origins and
+        destinations are lists of (lat, lon) tuples. This default
+        implementation finds the travel times pair by pair, backends with a
+        table service override it. Once cancel (a threading.Event) is set,
+        no more travel times are requested and the remaining ones are None,
+        unlike failed lookups (-1).
+        '''
+        rows = []
+        for o in origins:
+            row = []
+            for d in destinations:
+                if cancel is not None and cancel.is_set():
+                    row.append(None)
+                else:
+                    row.append(self.travel_time(o[0], o[1], d[0], d[1]))
+            rows.append(row)
+        return rows
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SeleniumBackend(RoutingBackend):
+    '''Scrape travel times from the OpenStreetMaps website using headless
+    Firefox browsers.
+
+    Instead of sleeping for a fixed time, every lookup polls the page until
+    the routing summary shows a travel time, so that it returns as soon as
+    the page is rendered. The timeout of the polling adapts to the latencies
+    of the recent lookups and is at most wait_time seconds. Browsers are
+    kept warm in a pool shared by all threads, a thread takes an idle
+    browser for every lookup and starts a new one only if none is idle.
+    open() starts warm_browsers browsers in advance.
+    '''
+
+    def __init__(self, wait_time=10.0, max_rate=None, warm_browsers=1):
+        super().__init__(max_rate)
+        # maximum time in seconds given to the browser to load the routing
+        # summary
+        self.wait_time = wait_time
+        self.warm_browsers = warm_browsers
         # the OpenStreetMaps url to be queried later
         self.url_templ = 'https://www.openstreetmap.org/directions?engine=fo' \
                          + 'ssgis_osrm_car&route={:.4f}%2C{:.4f}%3B{:.4f}%2C' \
                          + '{:.4f}#map=5/55.781/-5.962'
+        self.idle = queue.Queue()  # pool of idle browsers
+        self.drivers = []  # all browsers started
+        self.drivers_lock = threading.Lock()
+        # the timeout is timeout_factor times the 95th percentile of the
+        # last latency_window latencies, but at least min_wait_time; until
+        # min_samples latencies are known, wait_time is used
+        self.timeout_factor = 2.0
+        self.min_wait_time = 0.5
+        self.min_samples = 5
+        self.latencies = collections.deque(maxlen=50)
+        self.latency_lock = threading.Lock()
+        self.poll_frequency = 0.1  # seconds between checks of the page
+
+    def start_driver(self):
+        '''Start a headless browser and add it to the list of browsers.'''
+        from selenium import webdriver
+        options = webdriver.firefox.options.Options()
+        options.headless = True
+        driver = webdriver.Firefox(options=options)
+        with self.drivers_lock:
+            self.drivers.append(driver)
+        return driver
+
+    def acquire_driver(self):
+        '''Return an idle browser, start one if none is idle.'''
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.start_driver()
+
+    def release_driver(self, driver):
+        '''Return a browser to the pool of idle browsers.'''
+        self.idle.put(driver)
+
+    def discard_driver(self, driver):
+        '''Quit a browser that failed, it's not used again.'''
+        with self.drivers_lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def open(self):
+        '''Start the warm browsers.'''
+        while self.idle.qsize() < self.warm_browsers:
+            self.release_driver(self.start_driver())
+
+    def close(self):
+        '''Close the headless browser sessions.'''
+        with self.drivers_lock:
+            for driver in self.drivers:
+                try:
+                    driver.quit()
+                except Exception:
+                    # a browser that crashed may fail to quit, the others
+                    # are still closed
+                    pass
+            self.drivers = []
+        self.idle = queue.Queue()
+
+    def timeout(self):
+        '''Return the time in seconds to wait for the routing summary.'''
+        with self.latency_lock:
+            if len(self.latencies) < self.min_samples:
+                return self.wait_time
+            p95 = np.percentile(self.latencies, 95)
+        return min(self.wait_time,
+                   max(self.min_wait_time, self.timeout_factor * p95))
+
+    def record_latency(self, seconds):
+        '''Record the time a lookup waited for the routing summary.'''
+        with self.latency_lock:
+            self.latencies.append(seconds)
+
+    def parse_summary(text):
+        '''Return travel time in minutes in the text of the routing summary,
+        None if it doesn't contain a travel time (yet).
+        '''
+        # the travel time is the last word, in the format h:mm
+        z = text.strip().split(' ')[-1].rstrip('.').split(':')
+        if len(z) != 2 or not (z[0].isdigit() and z[1].isdigit()):
+            return None
+        return int(z[0])*60 + int(z[1])
+
+    def travel_time(self, orig_lat, orig_lon, dest_lat, dest_lon):
+        '''Find driving distance between two points using OSM routing.'''
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        def summary_time(driver):
+            '''Return travel time in the routing summary as a string, False
+            while there's none.
+            '''
+            x = driver.find_elements(By.ID, 'routing_summary')
+            if len(x) == 0 or SeleniumBackend.parse_summary(x[0].text) \
+                    is None:
+                return False
+            return x[0].text
+
+        # URL to be requested
+        urlpage = self.url_templ.format(orig_lat, orig_lon, dest_lat, dest_lon)
+        timeout = self.timeout()
+        driver = None
+        try:
+            driver = self.acquire_driver()
+            self.throttle()
+            driver.get(urlpage)
+            start = time.monotonic()
+            # poll the page until the routing summary shows a travel time
+            text = WebDriverWait(driver, timeout, self.poll_frequency) \
+                .until(summary_time)
+        except TimeoutException:
+            # if 'routing summary' not found, return -1 as travel time; the
+            # timeout counts as a latency, so that repeated timeouts make the
+            # following lookups wait longer
+            self.record_latency(timeout)
+            self.release_driver(driver)
+            return -1
+        except Exception:
+            # the browser failed to start, crashed or hung, replace it by a
+            # new one
+            if driver is not None:
+                self.discard_driver(driver)
+            return -1
+        self.record_latency(time.monotonic() - start)
+        self.release_driver(driver)
+        return SeleniumBackend.parse_summary(text)
+
+
+class OSRMBackend(RoutingBackend):
+    '''Query the HTTP/JSON API of an OSRM routing server directly.
+
+    By default, the FOSSGIS server is used, which is also the car routing
+    engine behind the OpenStreetMaps website. Any server speaking the OSRM
+    API can be used instead, e.g. a local instance or a stand-in for testing
+    given as base_url='http://localhost:5000'. Connections are kept alive and
+    reused through a pooled HTTP session, which keeps up to pool_size
+    connections for concurrent requests. Matrices of travel times are
+    requested from the table service in chunks of at most max_table_size
+    coordinates (the default limit of osrm-routed).
+    '''
+
+    def __init__(self, base_url='https://routing.openstreetmap.de/routed-car',
+                 profile='driving', timeout=10.0, max_table_size=100,
+                 pool_size=10, max_rate=None):
+        super().__init__(max_rate)
+        self.base_url = base_url.rstrip('/')
+        self.profile = profile
+        self.timeout = timeout  # timeout in seconds for each HTTP request
+        self.max_table_size = max_table_size
+        self.pool_size = pool_size
+        self.session = None
+
+    def open(self):
+        '''Create HTTP session, which pools and reuses connections.'''
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        '''Close HTTP session and its connections.'''
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def request(self, service, coordinates, params=None):
+        '''Send request to given OSRM service (e.g. route or table) and return
+        the decoded JSON response. Coordinates are (lat, lon) tuples.
+        '''
+        if self.session is None:
+            self.open()
+        # OSRM expects coordinates in the format lon,lat;lon,lat;...
+        coords = ';'.join('{:.5f},{:.5f}'.format(lon, lat)
+                          for lat, lon in coordinates)
+        url = '{}/{}/v1/{}/{}'.format(self.base_url, service, self.profile,
+                                      coords)
+        self.throttle()
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        # no raise_for_status(): OSRM reports errors such as 'NoRoute' in
+        # the JSON body, which is handled by the callers
+        return response.json()
+
+    def travel_time(self, orig_lat, orig_lon, dest_lat, dest_lon):
+        '''Find driving distance between two points using the route service
+        of the OSRM server.
+        '''
+        import requests
+        try:
+            data = self.request('route', [(orig_lat, orig_lon),
+                                          (dest_lat, dest_lon)],
+                                {'overview': 'false'})
+        except (requests.RequestException, ValueError):
+            # network problem or response that is not valid JSON
+            return -1
+        if data.get('code') != 'Ok' or len(data.get('routes', [])) == 0:
+            return -1
+        # OSRM returns the duration in seconds
+        return int(round(data['routes'][0]['duration'] / 60))
+
+    def matrix_chunk_size(self, n_destinations):
+        '''Return the number of origins that fit into one request to the
+        table service together with the destinations.
+        '''
+        return max(1, self.max_table_size - n_destinations)
+
+    def travel_time_matrix(self, origins, destinations, cancel=None):
+        '''Find travel times from all origins to all destinations using the
+        table service of the OSRM server, one request per chunk of origins.
+        Once cancel is set, the remaining chunks are not requested and their
+        travel times are None.
+        '''
+        import requests
+        # every request contains all destinations and a chunk of origins
+        chunk_size = self.matrix_chunk_size(len(destinations))
+        rows = []
+        for k in range(0, len(origins), chunk_size):
+            chunk = list(origins[k:k+chunk_size])
+            if cancel is not None and cancel.is_set():
+                rows += [[None]*len(destinations) for o in chunk]
+                continue
+            n = len(chunk)
+            params = {'sources': ';'.join(str(i) for i in range(n)),
+                      'destinations': ';'.join(str(n+j) for j in
+                                               range(len(destinations))),
+                      'annotations': 'duration'}
+            try:
+                data = self.request('table', chunk + list(destinations),
+                                    params)
+            except (requests.RequestException, ValueError):
+                data = {}
+            if data.get('code') != 'Ok':
+                # the whole chunk failed, mark its travel times as not found
+                rows += [[-1]*len(destinations) for o in chunk]
+                continue
+            # durations in seconds, None where no route was found
+            for durations in data['durations']:
+                rows.append([-1 if x is None else int(round(x / 60))
+                             for x in durations])
+        return rows
+
+
+class TravelTimeCache():
+    '''Persistent cache of travel times between outcodes, stored in an
+    SQLite file.
+
+    Each entry records when it was fetched and when it was last used.
+    Entries older than max_age seconds are expired, and when the cache holds
+    more than max_entries entries, the least recently used ones are evicted.
+    Every write is a short transaction of its own, so that several searches
+    can share the file. The times of use are collected in memory and saved
+    together, at most every commit_interval seconds and when the cache is
+    closed. The cache is best-effort: if the file stays locked by another
+    process, a lookup counts as a miss and a write is skipped. The cache
+    can be shared by several threads.
+    '''
+
+    def __init__(self, path, max_age=30*24*3600, max_entries=1000000,
+                 commit_interval=5.0):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.last_commit = time.monotonic()
+        # transactions are started explicitly, see write(); with write-ahead
+        # logging, readers aren't blocked by a writer
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS travel_times ('
+                                'origin TEXT, destination TEXT, '
+                                'minutes INTEGER, fetched REAL, used REAL, '
+                                'PRIMARY KEY (origin, destination))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS travel_times_used '
+                                'ON travel_times (used)')
+        # times of use not saved yet, keyed by (origin, destination)
+        self.used = {}
+        # eviction needs a count of all entries, so it only runs every
+        # evict_interval insertions and when the cache is closed
+        self.evict_interval = 1000
+        self.puts_since_eviction = 0
+
+    def get(self, origin, destination):
+        '''Return cached travel time in minutes, None if the pair is not
+        cached, its entry has expired or the cache can't be read.
+        '''
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    'SELECT minutes, fetched FROM travel_times '
+                    'WHERE origin = ? AND destination = ?',
+                    (origin, destination)).fetchone()
+            except sqlite3.OperationalError:
+                return None
+            # expired entries are removed by evict()
+            if row is None or now - row[1] > self.max_age:
+                return None
+            self.used[(origin, destination)] = now
+            if time.monotonic() - self.last_commit >= self.commit_interval:
+                self.write(self.save_used)
+        return row[0]
+
+    def put(self, origin, destination, minutes):
+        '''Store travel time in minutes for the given pair of outcodes.'''
+        self.put_many([(origin, destination, minutes)])
+
+    def put_many(self, times):
+        '''Store travel times given as (origin, destination, minutes)
+        tuples, in one transaction.
+        '''
+        now = time.time()
+        rows = [(o, d, int(t), now, now) for o, d, t in times]
+
+        def insert():
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?, ?)',
+                rows)
+            self.puts_since_eviction += len(rows)
+            if self.puts_since_eviction >= self.evict_interval:
+                self.evict()
+            self.save_used()
+
+        with self.lock:
+            self.write(insert)
+
+    def write(self, changes):
+        '''Make the changes of the function changes in a short transaction,
+        skip them if the file stays locked. The caller must hold the lock.
+        '''
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            return
+        try:
+            changes()
+            self.connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            self.connection.execute('ROLLBACK')
+        self.last_commit = time.monotonic()
+
+    def save_used(self):
+        '''Save the times of use collected in memory. The caller must be in
+        a transaction.
+        '''
+        if len(self.used) > 0:
+            self.connection.executemany(
+                'UPDATE travel_times SET used = ? '
+                'WHERE origin = ? AND destination = ?',
+                ((t, o, d) for (o, d), t in self.used.items()))
+            self.used = {}
+
+    def evict(self):
+        '''Remove expired entries and the least recently used entries
+        exceeding max_entries. The caller must be in a transaction.
+        '''
+        self.connection.execute('DELETE FROM travel_times WHERE fetched < ?',
+                                (time.time() - self.max_age,))
+        count = self.connection.execute(
+            'SELECT COUNT(*) FROM travel_times').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM travel_times WHERE rowid IN (SELECT rowid FROM '
+                'travel_times ORDER BY used LIMIT ?)',
+                (count - self.max_entries,))
+        self.puts_since_eviction = 0
+
+    def close(self):
+        '''Save the times of use, evict old entries and close the SQLite
+        file.
+        '''
+        with self.lock:
+
+            def finish():
+                self.save_used()
+                self.evict()
+
+            self.write(finish)
+            self.connection.close()
+
+
+class Checkpoint():
+    '''Append-only file of the travel times found during a search, used to
+    resume the search after it was interrupted.
+
+    Each line holds origin, destination and travel time in minutes. The
+    file is flushed to disk at least every flush_interval seconds and when
+    it is closed.
+    '''
+
+    def __init__(self, path, flush_interval=10.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = None
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def load(self):
+        '''Return dictionary of the travel times in the checkpoint file,
+        keyed by (origin, destination). A line left incomplete by a crash is
+        ignored.
+        '''
+        times = {}
+        if not os.path.exists(self.path):
+            return times
+        with open(self.path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split(',')
+                if not line.endswith('\n') or len(fields) != 3:
+                    continue
+                try:
+                    times[(fields[0], fields[1])] = int(fields[2])
+                except ValueError:
+                    continue
+        return times
+
+    def record(self, origin, destination, minutes):
+        '''Append travel time in minutes for the given pair of outcodes.'''
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write('{},{},{}\n'.format(origin, destination,
+                                                int(minutes)))
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.last_flush = now
+
+    def close(self):
+        '''Flush and close the checkpoint file.'''
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+class WorkQueue():
+    '''Queue of the routing work of a batch of searches, shared by the
+    worker processes through an SQLite file, which can be on a file system
+    shared by several machines.
+
+    Each unique pair of origin and destination is stored once, with its
+    travel time in minutes once it's done. Workers claim chunks of pending
+    pairs; a claim expires after lease seconds, so that the pairs of a
+    worker that died are taken over by the others. A failed lookup leaves
+    its pair pending, it's claimed again until max_attempts lookups of the
+    pair have failed.
+    '''
+
+    def __init__(self, path, lease=600.0, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # transactions are started explicitly, see claim()
+        self.connection = sqlite3.connect(path, timeout=60.0,
+                                          isolation_level=None)
+        self.create_table()
+
+    def create_table(self):
+        '''Create the table of pairs if it doesn't exist.'''
+        # minutes is NULL until the pair is done, routed marks the travel
+        # times found by the workers rather than taken from the cache
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                                'origin TEXT, destination TEXT, '
+                                'minutes INTEGER, routed INTEGER, '
+                                'attempts INTEGER DEFAULT 0, '
+                                'claimed_by TEXT, claimed_at REAL, '
+                                'PRIMARY KEY (origin, destination))')
+
+    def reset(self):
+        '''Remove all pairs, e.g. those of a previous batch, by recreating
+        the table, which also replaces a table of an older layout.
+        '''
+        self.connection.execute('DROP TABLE IF EXISTS pairs')
+        self.create_table()
+
+    def add(self, pairs, known=None):
+        '''Add pending (origin, destination) pairs, pairs already in the
+        queue are kept. Travel times in known, a dictionary keyed by pairs,
+        are added as done but not routed.
+        '''
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO pairs (origin, destination) VALUES (?, ?)',
+            pairs)
+        if known:
+            self.connection.executemany(
+                'UPDATE pairs SET minutes = ?, routed = 0 '
+                'WHERE origin = ? AND destination = ?',
+                ((t, o, d) for (o, d), t in known.items()))
+        self.connection.execute('COMMIT')
+
+    def claim(self, worker, n):
+        '''Claim up to n pending pairs for worker and return them as a list
+        of (origin, destination) tuples, ordered by destination so that a
+        chunk needs few travel time matrices.
+        '''
+        now = time.time()
+        # an immediate transaction locks out the other workers between
+        # finding the pairs and marking them as claimed
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                'SELECT rowid, origin, destination FROM pairs '
+                'WHERE minutes IS NULL AND attempts < ? AND (claimed_at IS '
+                'NULL OR claimed_at < ?) ORDER BY destination, origin '
+                'LIMIT ?',
+                (self.max_attempts, now - self.lease, n)).fetchall()
+            self.connection.executemany(
+                'UPDATE pairs SET claimed_by = ?, claimed_at = ? '
+                'WHERE rowid = ?', ((worker, now, r[0]) for r in rows))
+        finally:
+            self.connection.execute('COMMIT')
+        return [(r[1], r[2]) for r in rows]
+
+    def complete(self, times):
+        '''Store the travel times of claimed pairs, a dictionary keyed by
+        (origin, destination). Pairs whose lookup failed (-1) are released
+        and stay pending, with one more failed attempt.
+        '''
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany(
+            'UPDATE pairs SET minutes = ?, routed = 1 '
+            'WHERE origin = ? AND destination = ?',
+            ((int(t), o, d) for (o, d), t in times.items() if t >= 0))
+        self.connection.executemany(
+            'UPDATE pairs SET attempts = attempts + 1, claimed_by = NULL, '
+            'claimed_at = NULL WHERE origin = ? AND destination = ?',
+            ((o, d) for (o, d), t in times.items() if t < 0))
+        self.connection.execute('COMMIT')
+
+    def pending(self):
+        '''Return the number of pairs not done yet, excluding those that
+        failed max_attempts times.
+        '''
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM pairs WHERE minutes IS NULL '
+            'AND attempts < ?', (self.max_attempts,)).fetchone()[0]
+
+    def results(self, routed_only=False):
+        '''Return dictionary of the travel times of all pairs done, keyed by
+        (origin, destination). If routed_only is True, only the travel
+        times found by the workers are returned.
+        '''
+        return {(o, d): t for o, d, t in self.connection.execute(
+            'SELECT origin, destination, minutes FROM pairs '
+            'WHERE minutes IS NOT NULL AND routed >= ?',
+            (1 if routed_only else 0,))}
+
+    def failed(self):
+        '''Return list of the pairs whose lookups failed max_attempts
+        times.
+        '''
+        return [(o, d) for o, d in self.connection.execute(
+            'SELECT origin, destination FROM pairs WHERE minutes IS NULL '
+            'AND attempts >= ?', (self.max_attempts,))]
+
+    def close(self):
+        '''Close the SQLite file.'''
+        self.connection.close()
+
+
+class ResultFile():
+    '''Table of postcodes found by a search, stored in a compact binary
+    file, written by a ResultWriter.
+
+    The file starts with a header: the magic bytes MAGIC, the format
+    version and the number of destinations (uint16), the max speed
+    (float64), and the id and distance in minutes of every destination
+    (uint16). Then follows one record per postcode: its id and its travel
+    times in minutes to the destinations (uint16, MISSING if not found),
+    all little-endian. The ids are those of the table of postcodes (see
+    get_pc_ids()). The records are read as a memory-mapped numpy array, so
+    that the results of many searches can be read without loading them
+    into pandas. Records are only ever appended, an incomplete record at
+    the end, e.g. of a file still being written, is ignored.
+    '''
+
+    MAGIC = b'PCFR'
+    VERSION = 1
+    MISSING = 65535
+    header_format = '<4sHHd'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            fixed = f.read(struct.calcsize(ResultFile.header_format))
+            try:
+                magic, version, n, self.max_speed = struct.unpack(
+                    ResultFile.header_format, fixed)
+            except struct.error:
+                magic = version = None
+            if magic != ResultFile.MAGIC or version != ResultFile.VERSION:
+                raise ValueError('not a result file: ' + path)
+            dests = np.frombuffer(f.read(4 * n), dtype='<u2').reshape(n, 2)
+        self.header_size = len(fixed) + 4 * n
+        self.destination_ids = dests[:, 0].copy()
+        self.limits = dests[:, 1].copy()
+        self.dtype = ResultFile.record_dtype(n)
+
+    def record_dtype(n_destinations):
+        '''Return numpy dtype of the records of a file with the given
+        number of destinations.
+        '''
+        return np.dtype([('id', '<u2'), ('minutes', '<u2', (n_destinations,))])
+
+    def records(self):
+        '''Return memory-mapped array of the records, with the fields id and
+        minutes (one column per destination).
+        '''
+        n = (os.path.getsize(self.path) - self.header_size) \
+            // self.dtype.itemsize
+        if n <= 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r',
+                         offset=self.header_size, shape=(n,))
+
+    def destination_distances(self):
+        '''Return dictionary of the destination distances of the search.'''
+        return dict(zip(ResultFile.postcodes(self.destination_ids),
+                        self.limits.astype(int).tolist()))
+
+    def postcodes(ids):
+        '''Return index of the postcodes with the given ids.'''
+        ids_table = get_pc_ids()
+        k = pd.Index(ids_table.values).get_indexer(ids)
+        if (k < 0).any():
+            raise ValueError('unknown postcode id in result file')
+        return ids_table.index[k]
+
+    def to_df(self):
+        '''Return the results as a table of postcodes like the one of the
+        PostcodeFinder, travel times not found are -1.
+        '''
+        records = self.records()
+        destinations = list(self.destination_distances().keys())
+        pc = get_pc_raw().reindex(
+            index=ResultFile.postcodes(records['id']),
+            columns=list(get_pc_raw().columns) + destinations)
+        minutes = records['minutes'].astype(int)
+        minutes[minutes == ResultFile.MISSING] = -1
+        for k, d in enumerate(destinations):
+            pc[d] = minutes[:, k]
+        return pc
+
+
+class ResultWriter():
+    '''Writes the postcodes found by a search to a ResultFile at path, given
+    the destination distances (a dictionary) and max speed of the search.
+    With append=True, the records are appended to an existing file of the
+    same search, otherwise a new file is started. Can be used as a context
+    manager. Raises ValueError if the distances don't fit in the header or
+    an existing file belongs to another search.
+    '''
+
+    def __init__(self, path, destination_distances, max_speed,
+                 append=False):
+        ResultWriter.check_distances(destination_distances)
+        self.path = path
+        self.destinations = list(destination_distances.keys())
+        self.dtype = ResultFile.record_dtype(len(self.destinations))
+        ids = get_pc_ids()[self.destinations].values
+        limits = [destination_distances[d] for d in self.destinations]
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            existing = ResultFile(path)
+            if existing.destination_distances() != \
+                    dict(destination_distances) \
+                    or existing.max_speed != float(max_speed):
+                raise ValueError('result file of another search: ' + path)
+            self.file = open(path, 'r+b')
+            # cut off an incomplete record left by a crash
+            n = (os.path.getsize(path) - existing.header_size) \
+                // self.dtype.itemsize
+            self.file.truncate(existing.header_size
+                               + n * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(struct.pack(ResultFile.header_format,
+                                        ResultFile.MAGIC, ResultFile.VERSION,
+                                        len(self.destinations), max_speed))
+            self.file.write(np.array([ids, limits], dtype='<u2').T.tobytes())
+
+    def check_distances(destination_distances):
+        '''Raise ValueError if a distance in minutes can't be stored in a
+        result file, i.e. is outside the range of uint16.
+        '''
+        for d, minutes in destination_distances.items():
+            if not 0 <= minutes <= ResultFile.MISSING:
+                raise ValueError('distance to {} too large for a result '
+                                 'file: {}'.format(d, minutes))
+
+    def write(self, postcode, times):
+        '''Append a postcode and its dictionary of travel times.'''
+        record = np.zeros(1, dtype=self.dtype)
+        record['id'] = get_pc_ids()[postcode]
+        record['minutes'] = [ResultWriter.encode(times.get(d, -1))
+                             for d in self.destinations]
+        self.file.write(record.tobytes())
+
+    def write_table(self, pc):
+        '''Append all postcodes of a table of postcodes, e.g. the table of
+        a PostcodeFinder.
+        '''
+        records = np.zeros(len(pc), dtype=self.dtype)
+        records['id'] = get_pc_ids().reindex(pc.index).values
+        for k, d in enumerate(self.destinations):
+            if d in pc.columns:
+                minutes = pc[d].fillna(-1).values
+            else:
+                minutes = np.full(len(pc), -1)
+            records['minutes'][:, k] = np.where(
+                minutes < 0, ResultFile.MISSING,
+                np.minimum(minutes, ResultFile.MISSING - 1))
+        self.file.write(records.tobytes())
+
+    def encode(minutes):
+        '''Return travel time in minutes as stored in a record.'''
+        if minutes < 0:
+            return ResultFile.MISSING
+        return min(int(minutes), ResultFile.MISSING - 1)
+
+    def flush(self):
+        '''Write the records appended so far to the file.'''
+        self.file.flush()
+
+    def close(self):
+        '''Close the file.'''
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Metrics():
+    '''Collects metrics of searches: counters, gauges and histograms of
+    durations in seconds. Metrics are identified by a name and optional
+    labels, e.g. observe('stage_seconds', 0.5, stage='search'). The
+    histograms count the durations in the buckets given by their upper
+    bounds (latency_buckets by default), from which the tail latencies are
+    estimated. export() writes the metrics to sink (a MetricsSink). The
+    metrics can be updated from several threads at once.
+    '''
+
+    def __init__(self, sink=None, buckets=None):
+        self.sink = sink
+        self.buckets = tuple(latency_buckets if buckets is None
+                             else buckets)
+        self.lock = threading.Lock()
+        # values keyed by (name, labels), where labels is a sorted tuple of
+        # (label, value) pairs
+        self.counters = {}
+        self.gauges = {}
+        # histograms: counts per bucket (the last one is unbounded), sum and
+        # maximum of the durations
+        self.histograms = {}
+
+    def key(name, labels):
+        '''Return key of a metric with the given name and labels.'''
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, n=1, **labels):
+        '''Add n to a counter.'''
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        '''Set a gauge to value.'''
+        with self.lock:
+            self.gauges[Metrics.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        '''Record a duration in seconds in a histogram.'''
+        key = Metrics.key(name, labels)
+        k = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0, 'max': 0.0}
+            h['counts'][k] += 1
+            h['sum'] += seconds
+            h['max'] = max(h['max'], seconds)
+
+    def quantile(self, h, q):
+        '''Return estimate of the q-quantile of a histogram, the upper
+        bound of the bucket containing it (the maximum for the last one).
+        '''
+        rank = q * sum(h['counts'])
+        total = 0
+        for bound, n in zip(self.buckets, h['counts']):
+            total += n
+            if total >= rank:
+                return min(bound, h['max'])
+        return h['max']
+
+    def snapshot(self):
+        '''Return dictionary of the current values of the metrics, keyed by
+        name with labels in the Prometheus notation.
+        '''
+        with self.lock:
+            return {
+                'counters': {Metrics.format_key(k): v
+                             for k, v in sorted(self.counters.items())},
+                'gauges': {Metrics.format_key(k): v
+                           for k, v in sorted(self.gauges.items())},
+                'histograms': {
+                    Metrics.format_key(k): {
+                        'count': sum(h['counts']), 'sum': h['sum'],
+                        'max': h['max'], 'p50': self.quantile(h, 0.5),
+                        'p95': self.quantile(h, 0.95),
+                        'p99': self.quantile(h, 0.99)}
+                    for k, h in sorted(self.histograms.items())}}
+
+    def format_key(key, extra=()):
+        '''Return name and labels of a metric in the Prometheus notation,
+        e.g. stage_seconds{stage="search"}.
+        '''
+        name, labels = key
+        labels = labels + tuple(extra)
+        if len(labels) == 0:
+            return name
+        return '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, value) for label, value in labels))
+
+    def export(self):
+        '''Write the metrics to the sink.'''
+        if self.sink is not None:
+            self.sink.write(self)
+
+
+class NullMetrics(Metrics):
+    '''Metrics that are not collected, the default of the PostcodeFinder.
+    All methods return immediately, so the instrumentation costs next to
+    nothing when it's disabled.
+    '''
+
+    def count(self, name, n=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def export(self):
+        pass
+
+
+class MetricsSink():
+    '''Interface of the destinations of Metrics. Subclasses implement
+    write(), which is called with the Metrics at the end of every search.
+    '''
+
+    def write(self, metrics):
+        '''Write the current values of metrics.'''
+        raise NotImplementedError
+
+
+class JSONLinesSink(MetricsSink):
+    '''Appends the metrics as one JSON object per line to the file at path,
+    with the time of the export, so that the file is a log of all
+    searches.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, metrics):
+        record = {'time': time.time()}
+        record.update(metrics.snapshot())
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class PrometheusTextSink(MetricsSink):
+    '''Writes the metrics in the Prometheus text format to the file at
+    path, replacing the previous values, e.g. for the textfile collector of
+    the node exporter. Metric names are prefixed with prefix, counters get
+    the suffix _total.
+    '''
+
+    def __init__(self, path, prefix='postcode_finder_'):
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, metrics):
+        lines = []
+        types = set()
+
+        def add(kind, key, suffix, value, extra=()):
+            name = self.prefix + key[0]
+            if name not in types:
+                lines.append('# TYPE {} {}'.format(name, kind))
+                types.add(name)
+            lines.append('{} {}'.format(Metrics.format_key(
+                (name + suffix, key[1]), extra), value))
+
+        with metrics.lock:
+            for key, value in sorted(metrics.counters.items()):
+                add('counter', (key[0] + '_total', key[1]), '', value)
+            for key, value in sorted(metrics.gauges.items()):
+                add('gauge', key, '', value)
+            for key, h in sorted(metrics.histograms.items()):
+                total = 0
+                bounds = [repr(float(b)) for b in metrics.buckets] + ['+Inf']
+                for bound, n in zip(bounds, h['counts']):
+                    total += n
+                    add('histogram', key, '_bucket', total,
+                        (('le', bound),))
+                add('histogram', key, '_sum', h['sum'])
+                add('histogram', key, '_count', total)
+        # replace the file at once, so that it's never read half-written
+        with open(self.path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+
+class TravelTimeMatrix():
+    '''Precomputed matrix of travel times in minutes between outcodes,
+    built by build_travel_matrix().
+
+    The matrix is stored as a memory-mapped numpy array of uint16 in the
+    file path + '.npy', with one row per destination and one column per
+    origin, and the list of outcodes is stored in the text file
+    path + '.outcodes'. Pairs that were not computed, e.g. those beyond the
+    radius of a sparse matrix, and failed lookups hold MISSING.
+    '''
+
+    MISSING = 65535
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.outcodes') as f:
+            self.index = pd.Index([line.strip() for line in f
+                                   if line.strip()], name='postcode')
+        self.minutes = np.load(path + '.npy', mmap_mode='r')
+
+    def lookup(self, destinations, origins):
+        '''Return array of travel times with one row per destination and
+        one column per origin, MISSING where not available.
+        '''
+        i = self.index.get_indexer(destinations)
+        j = self.index.get_indexer(origins)
+        times = np.full((len(i), len(j)), TravelTimeMatrix.MISSING,
+                        dtype=np.uint16)
+        rows = i >= 0
+        cols = j >= 0
+        times[np.ix_(rows, cols)] = self.minutes[np.ix_(i[rows], j[cols])]
+        return times
+
+
+class OutcodeIndex():
+    '''Spatial index over a table of postcodes with latitude and longitude
+    columns, built once when the table is loaded.
+
+    The postcodes are kept sorted by latitude, so that a query only scans
+    the band of latitudes covering the query area, which is found by binary
+    search. Queries return the positions (row numbers) of the matching
+    postcodes in the table, in the order of the table.
+    '''
+
+    def __init__(self, pc):
+        self.table_lat = pc.latitude.values
+        self.table_lon = pc.longitude.values
+        # positions of the postcodes sorted by latitude
+        self.order = np.argsort(self.table_lat, kind='mergesort')
+        self.lat = self.table_lat[self.order]
+        self.lon = self.table_lon[self.order]
+
+    def query_box(self, min_lat, min_lon, max_lat, max_lon):
+        '''Return positions of the postcodes within the given frame.'''
+        i = np.searchsorted(self.lat, min_lat, side='left')
+        j = np.searchsorted(self.lat, max_lat, side='right')
+        lon = self.lon[i:j]
+        hits = self.order[i:j][(lon >= min_lon) & (lon <= max_lon)]
+        return np.sort(hits)
+
+    def query_radius(self, lat, lon, radius):
+        '''Return positions of the postcodes within the given
+        as-the-crow-flies distance in km of a point.
+        '''
+        delta_lat = PostcodeFinder.compute_delta(lat, lon, radius, 'lat')
+        delta_lon = PostcodeFinder.compute_delta(lat, lon, radius, 'lon')
+        hits = self.query_box(lat-delta_lat, lon-delta_lon,
+                              lat+delta_lat, lon+delta_lon)
+        dist = PostcodeFinder.compute_distance(self.table_lat[hits],
+                                               self.table_lon[hits], lat, lon)
+        return hits[dist <= radius]
+
+
+class PostcodeFinder():
+
+    def __init__(self, destination_distances, max_speed, cache=None,
+                 travel_matrix=None, metrics=None):
+        '''Set up the search for postcodes. Travel times are taken from the
+        precomputed travel_matrix (a TravelTimeMatrix) and looked up in the
+        cache (a TravelTimeCache) first, if those are given. The routing
+        calls and the stages of the search are instrumented in metrics (a
+        Metrics), if given.
+        '''
+        self.metrics = NullMetrics() if metrics is None else metrics
+        start = time.perf_counter()
+        # dictionary of destination distances
+        self.destination_distances = destination_distances
+        self.max_speed = max_speed  # maximum speed in km per minute
+        self.cache = cache
+        # checkpoint file to record travel times, set in pcf_main(), and
+        # travel times known before the search, keyed by (origin, dest)
+        self.checkpoint = None
+        self.known = {}
+        self.cancelled = False  # set if the search was cancelled
+        # the routing session is only opened once a travel time has to be
+        # routed, see open_backend()
+        self.backend_open = False
+        self.backend_lock = threading.Lock()
+        pc_raw = get_pc_raw()
         # list of destinations and dictionary with their coordinates
         self.destinations = list(self.destination_distances.keys())
         self.destination_coordinates = {}
@@ -47,15 +1176,27 @@ class PostcodeFinder():
         self.set_boundaries(max_speed)
         sb = self.search_boundaries
         # restrict raw dataframe of postcodes to the search area
-        self.pc = pc_raw[pc_raw.latitude.ge(sb[0])
-                         & pc_raw.longitude.ge(sb[1])
-                         & pc_raw.latitude.le(sb[2])
-                         & pc_raw.longitude.le(sb[3])]
+        self.pc = pc_raw.iloc[get_pc_index().query_box(*sb)]
+        # restrict further to the intersection of the circles around the
+        # destinations, postcodes in the corners of the frames are too far
+        # away as the crow flies to satisfy the distance requirements
+        in_frames = len(self.pc)
+        self.pc = self.pc[self.within_search_circles(self.pc.latitude.values,
+                                                     self.pc.longitude.values)]
+        # each postcode removed saves one routing call per destination
+        self.routing_calls_avoided = (in_frames - len(self.pc)) \
+            * len(self.destinations)
         temp_col_list = list(pc_raw.columns) + self.destinations
         # add columns for distances to destinations,
         # those distances will be computed in in pcf_main()
         self.pc = self.pc.reindex(columns=temp_col_list)
+        if travel_matrix is not None:
+            self.use_travel_matrix(travel_matrix)
+        self.metrics.observe('stage_seconds', time.perf_counter() - start,
+                             stage='set_up')
         print('Number of postcodes within given area:', len(self.pc))
+        print('Routing calls avoided by pre-filtering:',
+              self.routing_calls_avoided)
 
     def set_boundaries(self, max_speed):
         '''Set the boundaries for the search.'''
@@ -88,59 +1229,393 @@ class PostcodeFinder():
         print('Latitude : ', (sb[0], sb[2]))
         print('Longitude: ', (sb[1], sb[3]))
 
-    def pcf_main(self, wait_time):
-        '''Computes distance in minutes by car.'''
-        # headless browser session to query OpenStreetMaps routing
-        options = webdriver.firefox.options.Options()
-        options.headless = True
-        driver = webdriver.Firefox(options=options)
-        # loop over columns, i.e. destination postcodes
-        print('Loop over destination postcodes and determine distances ...')
+    def use_travel_matrix(self, travel_matrix):
+        '''Take travel times from a precomputed TravelTimeMatrix. Postcodes
+        failing a distance requirement according to the matrix are removed
+        right away, the other travel times in the matrix become known travel
+        times, so that only pairs missing in the matrix are routed.
+        '''
+        times = travel_matrix.lookup(self.destinations, self.pc.index)
+        limits = np.array([self.destination_distances[d]
+                           for d in self.destinations])[:, np.newaxis]
+        available = times != TravelTimeMatrix.MISSING
+        fails = (available & (times > limits)).any(axis=0)
+        for k, d in enumerate(self.destinations):
+            use = available[k] & ~fails
+            self.known.update(zip(zip(self.pc.index[use],
+                                      [d]*int(use.sum())),
+                                  times[k, use].astype(int).tolist()))
+        self.pc = self.pc[~fails]
+        # the travel times of the postcodes removed are not routed, those
+        # that became known are counted when they're used
+        self.routing_calls_avoided += int(fails.sum()) * len(self.destinations)
+        print('Travel times taken from travel time matrix:',
+              int(available.sum()))
+
+    def within_search_circles(self, lat, lon):
+        '''Return boolean array marking the points (given by arrays of
+        coordinates) that are within the as-the-crow-flies distance
+        max_speed * distance of every destination.
+        '''
+        mask = np.ones(len(lat), dtype=bool)
+        for d in self.destinations:
+            dest_lat, dest_lon = self.destination_coordinates[d]
+            dist = PostcodeFinder.compute_distance(lat, lon,
+                                                   dest_lat, dest_lon)
+            mask &= dist <= self.max_speed * self.destination_distances[d]
+        return mask
+
+    def pcf_main(self, backend, matrix=False, workers=1, retries=0,
+                 checkpoint=None, resume=False, on_result=None,
+                 on_progress=None, cancel=None):
+        '''Computes distance in minutes by car using the given routing
+        backend (an instance of a RoutingBackend subclass). If matrix is
+        True, all travel times are requested as one matrix (in chunks)
+        rather than pair by pair. Otherwise, up to workers requests are
+        made concurrently. Lookups that fail (travel time -1) are repeated
+        up to retries times. Travel times found are recorded in checkpoint
+        (a Checkpoint) if given. If resume is True, the travel times already
+        in the checkpoint are reused and only the missing ones are computed.
+        If given, on_result(postcode, times) is called for every postcode
+        satisfying the distance requirements as soon as it is found, and
+        on_progress(done, total) whenever a postcode has been checked. The
+        search stops early when cancel (a threading.Event) is set.
+        '''
+        for p, times in self.iter_results(backend, matrix, workers, retries,
+                                          checkpoint, resume, on_progress,
+                                          cancel):
+            if on_result is not None:
+                on_result(p, times)
+
+    def iter_results(self, backend, matrix=False, workers=1, retries=0,
+                     checkpoint=None, resume=False, on_progress=None,
+                     cancel=None):
+        '''Generator version of pcf_main(), yields (postcode, times) for
+        every postcode satisfying the distance requirements as soon as it is
+        found, where times is a dictionary of the travel times to the
+        destinations. The table of postcodes is complete once the generator
+        is exhausted. If the search is cancelled, outstanding lookups are
+        stopped, the table only contains the postcodes found so far and the
+        attribute cancelled is set to True.
+        '''
+        self.cancelled = False
+        self.checkpoint = checkpoint
+        start = time.perf_counter()
+        if checkpoint is not None and resume:
+            self.known.update(checkpoint.load())
+            print('Travel times loaded from checkpoint:', len(self.known))
+        executor = None
+        if workers > 1 and not matrix:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        results = {}  # travel times by origin postcode
+        found = 0  # number of postcodes satisfying the requirements
+        rows = None
+        try:
+            # the lookups check cancel too, so that a chunk of a matrix or
+            # the destinations of a running lookup are not all routed
+            if matrix:
+                rows = self.iter_distance_matrix(backend, retries, cancel)
+            else:
+                rows = self.iter_distances(backend, executor, retries,
+                                           cancel)
+            for p, times in rows:
+                results[p] = times
+                if on_progress is not None:
+                    on_progress(len(results), len(self.pc))
+                if self.satisfies(times):
+                    found += 1
+                    if found == 1:
+                        self.metrics.observe('stage_seconds',
+                                             time.perf_counter() - start,
+                                             stage='first_result')
+                    yield p, times
+                if cancel is not None and cancel.is_set():
+                    break
+            if cancel is not None and cancel.is_set():
+                self.cancelled = True
+                print('Search cancelled')
+        finally:
+            if rows is not None:
+                rows.close()  # cancels outstanding lookups
+            if executor is not None:
+                executor.shutdown()
+            if self.backend_open:
+                backend.close()  # close the routing session
+                self.backend_open = False
+            if checkpoint is not None:
+                checkpoint.close()
+        self.metrics.observe('stage_seconds', time.perf_counter() - start,
+                             stage='search')
+        start = time.perf_counter()
+        # fill in the destination columns, travel times of destinations
+        # skipped after a failed requirement are missing
+        for d in self.destinations:
+            self.pc[d] = [results.get(p, {}).get(d, np.nan)
+                          for p in self.pc.index]
+        # remove postcodes that don't satisfy the distance requirements,
+        # including those with missing travel times
         for d in self.destinations:
-            print('Destination:', d, '; Postcodes to check:', len(self.pc))
-            progress = 0
-            dest_coord = self.destination_coordinates[d]
-            dest_lat = dest_coord[0]
-            dest_lon = dest_coord[1]
-            # loop over rows, i.e. origin postcodes and find distances
-            for p in list(self.pc.index):
-                orig_lat = self.pc.at[p, 'latitude']
-                orig_lon = self.pc.at[p, 'longitude']
-                t = self.get_distance(orig_lat, orig_lon,
-                                      dest_lat, dest_lon, driver, wait_time)
-                self.pc.loc[p, d] = t
-                progress += 1
-                print(progress, '\t', p, '\t Time:', t)
-            # remove postcodes that don't satisfy the distance requirement
-            # for the destination that has just been computed
             self.pc = self.pc[self.pc[d].le(self.destination_distances[d])]
             self.pc = self.pc.astype({d: int})
-        driver.quit()  # close the headless browser session
-        # remove postcodes that don't satisfy distance requ in the last column
-        d = list(self.pc.columns)[-1]
-        self.pc = self.pc[self.pc[d].le(self.destination_distances[d])]
+        self.metrics.observe('stage_seconds', time.perf_counter() - start,
+                             stage='fill_table')
+        self.metrics.set('postcodes_checked', len(results))
+        self.metrics.set('postcodes_found', len(self.pc))
+        self.metrics.set('routing_calls_avoided', self.routing_calls_avoided)
+        self.metrics.set('search_cancelled', int(self.cancelled))
+        self.metrics.export()
         print('... Done')
         print('Number of postcodes satisfying distance requirements:',
               len(self.pc))
 
-    def get_distance(self, orig_lat, orig_lon, dest_lat, dest_lon,
-                     driver, wait_time):
-        '''Find driving distance between two points using OSM routing.'''
-        # URL to be requested
-        urlpage = self.url_templ.format(orig_lat, orig_lon, dest_lat, dest_lon)
-        driver.get(urlpage)
-        time.sleep(wait_time)  # wait to give browser time to load content
-        # extract cell containing the travel time from the routing summary
-        x = driver.find_elements_by_xpath("//*[@id='routing_summary']")
-        if len(x) == 0:
-            # if 'routing summary' not found, return -1 as travel time
-            ret_value = -1
+    def satisfies(self, times):
+        '''Check whether a dictionary of travel times to the destinations
+        satisfies all distance requirements.
+        '''
+        return len(times) == len(self.destinations) \
+            and all(t <= self.destination_distances[d]
+                    for d, t in times.items())
+
+    def order_destinations(self):
+        '''Return the destinations ordered by expected selectivity, the most
+        selective first. The selectivity of a destination is estimated by the
+        mean as-the-crow-flies distance of the postcodes to be checked,
+        relative to the radius max_speed * distance of its search circle:
+        the closer the postcodes are to the edge of the circle, the more of
+        them are expected to fail the distance requirement.
+        '''
+        if len(self.pc) == 0:
+            return list(self.destinations)
+
+        def selectivity(d):
+            lat, lon = self.destination_coordinates[d]
+            dist = PostcodeFinder.compute_distance(self.pc.latitude.values,
+                                                   self.pc.longitude.values,
+                                                   lat, lon)
+            return np.mean(dist) / (self.max_speed
+                                    * self.destination_distances[d])
+
+        return sorted(self.destinations, key=selectivity, reverse=True)
+
+    def iter_distances(self, backend, executor=None, retries=0,
+                       cancel=None):
+        '''Loop over origins and destinations and yield (postcode, times)
+        for every origin as soon as its travel times are found. If an
+        executor is given, the origins are processed concurrently and
+        yielded in the order in which they are completed. Once cancel (a
+        threading.Event) is set, running lookups stop before the next
+        destination.
+        '''
+        order = self.order_destinations()
+        print('Loop over postcodes and determine distances to destinations',
+              'in the order', order, '...')
+        origins = list(self.pc.index)
+
+        def evaluate(p):
+            '''Return dictionary of travel times from origin p, stop at the
+            first destination whose distance requirement is not satisfied.
+            '''
+            times = {}
+            for d in order:
+                if cancel is not None and cancel.is_set():
+                    break
+                times[d] = self.get_distance(p, d, backend, retries, cancel)
+                if times[d] > self.destination_distances[d]:
+                    break
+            return times
+
+        futures = {}
+        if executor is None:
+            results = ((p, evaluate(p)) for p in origins)
         else:
-            # otherwise, extract travel time and return
-            y = x[0].text  # string containing time in the format h:mm
-            z = y.split(' ')[-1].rstrip('.').split(':')
-            ret_value = int(z[0])*60 + int(z[1])
-        return ret_value
+            futures = {executor.submit(evaluate, p): p for p in origins}
+            results = ((futures[f], f.result()) for f in as_completed(futures))
+        progress = 0
+        try:
+            for p, times in results:
+                # destinations skipped after a failed requirement and known
+                # travel times aren't routed, each counted once; those left
+                # by a cancelled lookup are not avoided
+                stopped = any(t > self.destination_distances[d]
+                              for d, t in times.items())
+                self.routing_calls_avoided += sum(
+                    1 for d in order
+                    if (stopped and d not in times)
+                    or (d in times and (p, d) in self.known))
+                progress += 1
+                print(progress, '\t', p, '\t Times:',
+                      PostcodeFinder.format_times(times))
+                yield p, times
+        finally:
+            # cancel outstanding lookups if the search is stopped early
+            for f in futures:
+                f.cancel()
+        print('Routing calls avoided in total:', self.routing_calls_avoided)
+
+    def iter_distance_matrix(self, backend, retries=0, cancel=None):
+        '''Find travel times from all origins to all destinations using the
+        travel time matrix of the backend, and yield (postcode, times) for
+        every origin. Origins whose travel times are all known or cached
+        come first, the others follow chunk by chunk. Once cancel (a
+        threading.Event) is set, no more travel times are requested and
+        only the origins whose travel times were all found are yielded.
+        '''
+        print('Request travel times for', len(self.pc), 'postcodes and',
+              len(self.destinations), 'destinations ...')
+        # take known or cached travel times where possible, only origins
+        # with at least one travel time missing are sent to the backend
+        missing = []
+        for p in self.pc.index:
+            times = {}
+            for d in self.destinations:
+                t = self.lookup_distance(p, d)
+                if t is None:
+                    break
+                times[d] = t
+            if len(times) == len(self.destinations):
+                # origins with a travel time missing are routed completely
+                self.routing_calls_avoided += sum(
+                    1 for d in self.destinations if (p, d) in self.known)
+                yield p, times
+            else:
+                missing.append(p)
+        print('Travel times known or cached for',
+              len(self.pc) - len(missing), 'postcodes')
+        chunk_size = backend.matrix_chunk_size(len(self.destinations))
+        for k in range(0, len(missing), chunk_size):
+            if cancel is not None and cancel.is_set():
+                return
+            chunk = missing[k:k+chunk_size]
+            rows = self.request_matrix(chunk, backend, retries, cancel)
+            cancelled = cancel is not None and cancel.is_set()
+            for p in chunk:
+                # rows of a cancelled chunk have travel times not requested
+                if not cancelled or None not in rows[p]:
+                    yield p, dict(zip(self.destinations, rows[p]))
+
+    def request_matrix(self, origins, backend, retries=0, cancel=None):
+        '''Return dictionary of travel time rows, keyed by origin postcode,
+        from the travel time matrix of the backend. Origins with failed
+        lookups are requested again up to retries times, unless cancel (a
+        threading.Event) is set.
+        '''
+        self.open_backend(backend)
+        pc_raw = get_pc_raw()
+        dests = [self.destination_coordinates[d] for d in self.destinations]
+        rows = {}
+        missing = origins
+        for attempt in range(retries + 1):
+            if len(missing) == 0 \
+                    or (attempt > 0 and cancel is not None
+                        and cancel.is_set()):
+                break
+            coords = [(pc_raw.at[p, 'latitude'], pc_raw.at[p, 'longitude'])
+                      for p in missing]
+            if attempt > 0:
+                self.metrics.count('routing_retries', len(missing))
+            start = time.perf_counter()
+            matrix = backend.travel_time_matrix(coords, dests, cancel)
+            self.metrics.observe('routing_latency_seconds',
+                                 time.perf_counter() - start, kind='matrix')
+            self.metrics.count('routing_requests', kind='matrix')
+            failed = []
+            for p, row in zip(missing, matrix):
+                rows[p] = row
+                # travel times not requested after cancel are None, they
+                # are neither failures nor stored
+                failures = sum(1 for t in row if t is not None and t < 0)
+                if failures > 0:
+                    failed.append(p)
+                    self.metrics.count('routing_failures', failures,
+                                       kind='matrix')
+            self.store_distances([(p, d, t) for p in missing
+                                  for d, t in zip(self.destinations,
+                                                  rows[p])
+                                  if t is not None])
+            missing = failed
+        return rows
+
+    def open_backend(self, backend):
+        '''Open the routing session, e.g. a headless browser session or a
+        pooled HTTP session, depending on the backend, unless it's open
+        already. Called before the first lookup that needs the backend, so
+        that a search whose travel times are all known never opens it.
+        '''
+        if self.backend_open:
+            return
+        with self.backend_lock:
+            if not self.backend_open:
+                backend.open()
+                self.backend_open = True
+
+    def get_distance(self, orig, dest, backend, retries=0, cancel=None):
+        '''Find driving distance between two postcodes. Known travel times
+        and the cache are checked first, the backend is only used if the
+        distance is not found there. A failed lookup (travel time -1) is
+        repeated up to retries times, unless cancel (a threading.Event) is
+        set.
+        '''
+        t = self.lookup_distance(orig, dest)
+        if t is not None:
+            return t
+        self.open_backend(backend)
+        dest_lat, dest_lon = self.destination_coordinates[dest]
+        orig_lat = get_pc_raw().at[orig, 'latitude']
+        orig_lon = get_pc_raw().at[orig, 'longitude']
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                if cancel is not None and cancel.is_set():
+                    break
+                self.metrics.count('routing_retries')
+            start = time.perf_counter()
+            t = backend.travel_time(orig_lat, orig_lon, dest_lat, dest_lon)
+            self.metrics.observe('routing_latency_seconds',
+                                 time.perf_counter() - start, kind='pair')
+            self.metrics.count('routing_requests', kind='pair')
+            if t >= 0:
+                break
+            self.metrics.count('routing_failures', kind='pair')
+        self.store_distance(orig, dest, t)
+        return t
+
+    def lookup_distance(self, orig, dest):
+        '''Return known or cached driving distance between two postcodes,
+        None if it's neither known nor cached.
+        '''
+        t = self.known.get((orig, dest))
+        if t is not None:
+            self.metrics.count('known_hits')
+        elif self.cache is not None:
+            t = self.cache.get(orig, dest)
+            if t is None:
+                self.metrics.count('cache_misses')
+                return None
+            self.metrics.count('cache_hits')
+            if self.checkpoint is not None:
+                self.checkpoint.record(orig, dest, t)
+        return t
+
+    def store_distance(self, orig, dest, t):
+        '''Store driving distance found by the backend in the cache and the
+        checkpoint. Failed lookups (-1) are not stored, so that they are
+        retried next time.
+        '''
+        self.store_distances([(orig, dest, t)])
+
+    def store_distances(self, times):
+        '''Store driving distances given as (orig, dest, t) tuples, like
+        store_distance() but with one write to the cache.
+        '''
+        found = [x for x in times if x[2] >= 0]
+        if len(found) < len(times):
+            self.metrics.count('lookups_failed', len(times) - len(found))
+        if len(found) == 0:
+            return
+        if self.cache is not None:
+            self.cache.put_many(found)
+        if self.checkpoint is not None:
+            for orig, dest, t in found:
+                self.checkpoint.record(orig, dest, t)
 
     def compute_delta(lat, lon, dist, direction):
         '''Compute coordinate difference corresponding to given
@@ -157,7 +1632,8 @@ class PostcodeFinder():
 
     def compute_distance(a_lat, a_lon, b_lat, b_lon):
         '''Compute as-the-crow-flies distance in km between two points given
-        by coordinates.
+        by coordinates. The coordinates can also be numpy arrays, in which
+        case the distances are computed elementwise.
         '''
         R = 6371
         c = math.pi/180
@@ -167,9 +1643,13 @@ class PostcodeFinder():
         b_lon = b_lon * c
         d_lat = b_lat - a_lat
         d_lon = b_lon - a_lon
-        a = (math.sin(d_lat/2))**2 \
-            + math.cos(b_lat) * math.cos(a_lat) * (math.sin(d_lon/2))**2
-        return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+        a = (np.sin(d_lat/2))**2 \
+            + np.cos(b_lat) * np.cos(a_lat) * (np.sin(d_lon/2))**2
+        return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    def format_times(times):
+        '''Return dictionary of travel times as a string.'''
+        return ', '.join('{} {}'.format(d, t) for d, t in times.items())
 
     def get_pc_as_df(self):
         '''Return the table of postcodes as a pandas dataframe.'''
@@ -180,6 +1660,77 @@ class PostcodeFinder():
         return self.pc.to_string()
 
 
+class ShapeCache():
+    '''Postcode boundary shapes stored in a binary numpy file, which is
+    built from the shapefiles by build_shape_cache().
+
+    For each layer (Areas and Districts), the cache holds the names and the
+    bounding boxes of the shapes and their geometries in WKB format,
+    simplified with each of the tolerances in shape_tolerances. The bounding
+    boxes serve as an index, so that only the shapes within the visible area
+    are decoded, and decoded shapes are kept for later maps. The file is kept
+    open and an array is only read when a map needs it, so that only the
+    geometries of the tolerances in use are loaded.
+    '''
+
+    def __init__(self, path):
+        self.data = np.load(path)
+        # arrays read from the file so far, by name
+        self.arrays = {}
+        self.lock = threading.Lock()
+        self.tolerances = list(self.array('tolerances'))
+        # decoded geometries, keyed by (layer, tolerance index, shape), so
+        # that redrawing a map doesn't decode the same shapes again
+        self.geometries = {}
+
+    def array(self, name):
+        '''Return the array of the given name, read from the file the first
+        time it's needed.
+        '''
+        with self.lock:
+            if name not in self.arrays:
+                self.arrays[name] = self.data[name]
+            return self.arrays[name]
+
+    def tolerance_for(self, vis_boundaries):
+        '''Return the largest tolerance that is invisible on a map of the
+        given boundaries, i.e. less than 1/500 of its extent.
+        '''
+        vb = vis_boundaries
+        extent = max(vb[2]-vb[0], vb[3]-vb[1])
+        usable = [t for t in self.tolerances if t <= extent/500]
+        if len(usable) == 0:
+            return min(self.tolerances)
+        return max(usable)
+
+    def load(self, layer, boundaries, tolerance):
+        '''Return GeoDataFrame of the shapes of the given layer whose
+        bounding boxes intersect the boundaries (min_lat, min_lon, max_lat,
+        max_lon), simplified with the given tolerance.
+        '''
+        import geopandas
+        from shapely import wkb
+        k = self.tolerances.index(tolerance)
+        # format of the bounds: min_lon, min_lat, max_lon, max_lat
+        bounds = self.array(layer + '_bounds')
+        hits = np.nonzero((bounds[:, 0] <= boundaries[3])
+                          & (bounds[:, 1] <= boundaries[2])
+                          & (bounds[:, 2] >= boundaries[1])
+                          & (bounds[:, 3] >= boundaries[0]))[0]
+        buffer = self.array('{}_wkb_{}'.format(layer, k))
+        offsets = self.array('{}_offsets_{}'.format(layer, k))
+        geometries = []
+        for i in hits:
+            key = (layer, k, i)
+            if key not in self.geometries:
+                self.geometries[key] = \
+                    wkb.loads(buffer[offsets[i]:offsets[i+1]].tobytes())
+            geometries.append(self.geometries[key])
+        names = self.array(layer + '_names')
+        return geopandas.GeoDataFrame({'name': names[hits]},
+                                      geometry=geometries)
+
+
 class PostcodeVisualiser():
 
     def __init__(self, pcf):
@@ -190,13 +1741,48 @@ class PostcodeVisualiser():
         self.set_dest_coords()
         self.set_vis_boundaries()
         self.set_pc_centres()
-        self.background_map = geopandas.read_file('postcode_shapes'
-                                                  + '/Distribution/Areas.shp')
-        self.pc_shapes = geopandas.read_file('postcode_shapes'
-                                             + '/Distribution/Districts.shp') \
-                                  .rename(columns={'name': 'postcode'}) \
-                                  .set_index('postcode') \
-                                  .reindex(index=self.pcf.pc.index)
+        # only load the shapes within the visible area, simplified
+        # according to its size
+        shapes = get_shape_cache()
+        vb = self.vis_boundaries
+        tolerance = shapes.tolerance_for(vb)
+        self.background_image = self.get_background_image(shapes, tolerance)
+        self.pc_shapes = shapes.load('Districts', vb, tolerance) \
+                               .rename(columns={'name': 'postcode'}) \
+                               .set_index('postcode') \
+                               .reindex(index=self.pcf.pc.index)
+
+    def get_background_image(self, shapes, tolerance):
+        '''Return the background map of the visible area rendered as an
+        RGBA image. The images are kept in background_images, so that the
+        background is only drawn once for every visible area and reused
+        when the map is redrawn.
+        '''
+        key = (tuple(round(x, 6) for x in self.vis_boundaries), figure_size)
+        with background_lock:
+            image = background_images.pop(key, None)
+        if image is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            vb = self.vis_boundaries
+            fig = Figure(figsize=figure_size, dpi=100)
+            canvas = FigureCanvasAgg(fig)
+            fig.patch.set_alpha(0)  # the sea stays transparent
+            axs = fig.add_axes([0, 0, 1, 1])
+            axs.set_axis_off()
+            shapes.load('Areas', vb, tolerance).plot(
+                ax=axs, color='green', edgecolor='black')
+            axs.set_xlim(([vb[1], vb[3]]))
+            axs.set_ylim(([vb[0], vb[2]]))
+            axs.set_aspect('auto')
+            canvas.draw()
+            image = np.asarray(canvas.buffer_rgba()).copy()
+        with background_lock:
+            # the most recently used image is last, the oldest one goes
+            background_images[key] = image
+            while len(background_images) > max_background_images:
+                background_images.popitem(last=False)
+        return image
 
     def set_vis_boundaries(self):
 
@@ -226,26 +1812,77 @@ class PostcodeVisualiser():
         self.vis_boundaries = make_square(vb)
 
     def set_pc_centres(self):
-        temp_df = self.pcf.pc.reindex(columns=['latitude', 'longitude',
-                                               'coordinates'])
-        temp_df['coordinates'] = list(zip(temp_df.longitude, temp_df.latitude))
-        temp_df['coordinates'] = temp_df['coordinates'].apply(Point)
-        self.pc_centres = geopandas.GeoDataFrame(temp_df,
-                                                 geometry='coordinates')
+        import geopandas
+        temp_df = self.pcf.pc.reindex(columns=['latitude', 'longitude'])
+        self.pc_centres = geopandas.GeoDataFrame(
+            temp_df, geometry=PostcodeVisualiser.make_points(
+                temp_df.longitude.values, temp_df.latitude.values))
 
     def set_dest_coords(self):
+        import geopandas
         cols = list(self.pcf.pc.columns)
         cols.remove('longitude')
         cols.remove('latitude')
-        temp_df = pc_raw.reindex(index=cols)
-        temp_df['coordinates'] = list(zip(temp_df.longitude, temp_df.latitude))
-        temp_df['coordinates'] = temp_df['coordinates'].apply(Point)
-        self.dest_coords = geopandas.GeoDataFrame(temp_df,
-                                                  geometry='coordinates')
+        temp_df = get_pc_raw().reindex(index=cols)
+        self.dest_coords = geopandas.GeoDataFrame(
+            temp_df, geometry=PostcodeVisualiser.make_points(
+                temp_df.longitude.values, temp_df.latitude.values))
+
+    def make_points(x, y):
+        '''Return points with the given arrays of coordinates, constructed
+        in bulk if geopandas supports it.
+        '''
+        import geopandas
+        if hasattr(geopandas, 'points_from_xy'):
+            return geopandas.points_from_xy(x, y)
+        from shapely.geometry import Point
+        return [Point(a, b) for a, b in zip(x, y)]
+
+    def select_labels(self, axs, fontsize):
+        '''Return positions of the postcodes whose labels can be drawn without
+        overlapping, at most max_labels of them. Postcodes with shorter
+        travel times are labelled first.
+        '''
+        lon = self.pc_centres.longitude.values
+        lat = self.pc_centres.latitude.values
+        if len(lon) == 0:
+            return []
+        # size of a label in data coordinates (text of 4 characters in a
+        # box with padding), computed from the size of the axes in inches
+        vb = self.vis_boundaries
+        fig_width, fig_height = axs.figure.get_size_inches()
+        position = axs.get_position()
+        points_x = (vb[3]-vb[1]) / (fig_width*position.width*72)
+        points_y = (vb[2]-vb[0]) / (fig_height*position.height*72)
+        width = 3.6*fontsize*points_x
+        height = 1.8*fontsize*points_y
+        # candidates sorted by total travel time, only the first candidate
+        # in each cell of a grid of label size is kept
+        times = self.pcf.pc[self.pcf.destinations].values.sum(axis=1)
+        order = np.argsort(times, kind='mergesort')
+        cells = np.floor((lon[order]-vb[1]) / width).astype(int) * 100000 \
+            + np.floor((lat[order]-vb[0]) / height).astype(int)
+        first = np.unique(cells, return_index=True)[1]
+        candidates = order[np.sort(first)]
+        # labels in neighbouring cells can still overlap, so add the
+        # candidates one by one and skip those colliding with earlier ones
+        selected = []
+        for i in candidates:
+            if len(selected) >= max_labels:
+                break
+            if len(selected) == 0 or not np.any(
+                    (np.abs(lon[selected] - lon[i]) < width)
+                    & (np.abs(lat[selected] - lat[i]) < height)):
+                selected.append(i)
+        return selected
 
     def vis_main(self, parent):
+        from matplotlib.patches import Rectangle
+        from matplotlib import pyplot as plt
         fig, axs = plt.subplots(1, figsize=figure_size, dpi=100)
-        self.background_map.plot(ax=axs, color='green', edgecolor='black')
+        vb = self.vis_boundaries
+        axs.imshow(self.background_image, extent=(vb[1], vb[3], vb[0], vb[2]),
+                   aspect='auto', interpolation='bilinear', zorder=0)
         self.pc_shapes.plot(ax=axs, color='yellow', edgecolor='red')
         if parent.draw_search_area_CB_value.get():
             sb = self.pcf.search_boundaries
@@ -255,236 +1892,627 @@ class PostcodeVisualiser():
             axs.add_patch(rect)
         if parent.pc_labels_CB_value.get():
             props = dict(boxstyle='round', facecolor='linen', alpha=1)
-            for p in self.pc_centres.iterrows():
-                axs.text(p[1]['longitude'], p[1]['latitude'], p[0],
+            lon = self.pc_centres.longitude.values
+            lat = self.pc_centres.latitude.values
+            for i in self.select_labels(axs, 11):
+                axs.text(lon[i], lat[i], self.pc_centres.index[i],
                          horizontalalignment='center', fontsize=11, bbox=props)
-        self.dest_coords.plot(ax=axs, color='blue', markersize=40)
-        vb = self.vis_boundaries
+        # all destinations in one scatter plot, i.e. one artist
+        axs.scatter(self.dest_coords.longitude.values,
+                    self.dest_coords.latitude.values, color='blue', s=40,
+                    zorder=3)
         axs.set_xlim(([vb[1], vb[3]]))
         axs.set_ylim(([vb[0], vb[2]]))
         axs.set_aspect('auto')
         return fig, axs
 
 
-class Application(tk.Frame):
-    def __init__(self, master=None):
-        super().__init__(master)
-        self.pack()
-        self.create_widgets()
-
-    def create_widgets(self):
-
-        self.info_label = tk.Label(self)
-        self.info_label['text'] = 'Enter destination postcode ' \
-                                  + 'and maximum distance'
-        self.info_label.grid(row=0, column=0, columnspan=4)
-
-        self.dest1_label = tk.Label(self, text='Destination 1 ')
-        self.dest1_label.grid(row=1, column=0, sticky=tk.E)
-        self.dest2_label = tk.Label(self, text='Destination 2 ')
-        self.dest2_label.grid(row=2, column=0, sticky=tk.E)
-        self.dest3_label = tk.Label(self, text='Destination 3 ')
-        self.dest3_label.grid(row=3, column=0, sticky=tk.E)
-        self.dest1_pc_entry = tk.Entry(self, width=4)
-        self.dest1_pc_entry.grid(row=1, column=1)
-        self.dest2_pc_entry = tk.Entry(self, width=4)
-        self.dest2_pc_entry.grid(row=2, column=1)
-        self.dest3_pc_entry = tk.Entry(self, width=4)
-        self.dest3_pc_entry.grid(row=3, column=1)
-        self.dest1_dist_entry = tk.Entry(self, width=3)
-        self.dest1_dist_entry.grid(row=1, column=2)
-        self.dest2_dist_entry = tk.Entry(self, width=3)
-        self.dest2_dist_entry.grid(row=2, column=2)
-        self.dest3_dist_entry = tk.Entry(self, width=3)
-        self.dest3_dist_entry.grid(row=3, column=2)
-
-        self.dest_err_label = tk.Label(self, fg='red')
-        self.dest_err_label.grid(row=3, column=3)
-
-        self.sample_search_button = tk.Button(self)
-        self.sample_search_button['text'] = 'Sample search'
-        self.sample_search_button['command'] = self.enter_sample
-        self.sample_search_button.grid(row=4, column=0)
-
-        self.clear_button = tk.Button(self)
-        self.clear_button['text'] = 'Clear'
-        self.clear_button['command'] = self.clear_all
-        self.clear_button.grid(row=4, column=3, ipadx=32)
-
-        self.find_postcodes_button = tk.Button(self)
-        self.find_postcodes_button['text'] = 'Find postcodes'
-        self.find_postcodes_button['command'] = self.app_main
-        self.find_postcodes_button.grid(row=5, column=3, padx=10)
-
-        self.visualisation_label = tk.Label(self, text='Draw map')
-        self.visualisation_label.grid(row=5, column=0, sticky=tk.E)
-        self.visualisation_CB = tk.Checkbutton(self)
-        self.visualisation_CB_value = tk.IntVar()
-        self.visualisation_CB['variable'] = self.visualisation_CB_value
-        self.visualisation_CB.grid(row=5, column=1, sticky=tk.W)
-
-        self.output_ST = tkst.ScrolledText(self, width=48)
-        self.output_ST.grid(row=6, column=0, columnspan=4)
-
-        self.search_settings_label = tk.Label(self)
-        self.search_settings_label['text'] = '-- Search settings --'
-        self.search_settings_label.grid(row=7, column=0, columnspan=4)
-        self.max_speed_label = tk.Label(self, text='Max speed in km/min')
-        self.max_speed_label.grid(row=8, column=0, sticky=tk.E)
-        self.max_speed_entry = tk.Entry(self, width=3)
-        self.max_speed_entry.grid(row=8, column=1, columnspan=2, sticky=tk.W)
-        self.max_speed_entry.insert(0, 1.2)
-        self.spy_button = tk.Button(self)
-        self.spy_button['text'] = 'Spy search area'
-        self.spy_button['command'] = self.spy
-        self.spy_button.grid(row=8, column=3)
-
-        self.map_settings_label = tk.Label(self)
-        self.map_settings_label['text'] = '-- Map settings --'
-        self.map_settings_label.grid(row=9, column=0, columnspan=4)
-        self.pc_labels_label = tk.Label(self, text='Label postcodes')
-        self.pc_labels_label.grid(row=10, column=0, sticky=tk.E)
-        self.pc_labels_CB = tk.Checkbutton(self)
-        self.pc_labels_CB_value = tk.IntVar()
-        self.pc_labels_CB['variable'] = self.pc_labels_CB_value
-        self.pc_labels_CB.grid(row=10, column=1, sticky=tk.W)
-        self.draw_search_area_label = tk.Label(self, text='Draw search area')
-        self.draw_search_area_label.grid(row=10, column=3, sticky=tk.W)
-        self.draw_search_area_CB = tk.Checkbutton(self)
-        self.draw_search_area_CB_value = tk.IntVar()
-        self.draw_search_area_CB['variable'] = self.draw_search_area_CB_value
-        self.draw_search_area_CB.grid(row=10, column=2, sticky=tk.E)
-
-        self.technical_settings_label = tk.Label(self)
-        self.technical_settings_label['text'] = '-- Other settings --'
-        self.technical_settings_label.grid(row=11, column=0, columnspan=4)
-        self.save_label = tk.Label(self, text='Save dataframe as')
-        self.save_label.grid(row=12, column=0, sticky=tk.E)
-        self.save_entry = tk.Entry(self, width=8)
-        self.save_entry.grid(row=12, column=1, columnspan=2, sticky=tk.W)
-        self.wait_time_label = tk.Label(self, text='Browser wait time')
-        self.wait_time_label.grid(row=13, column=0, sticky=tk.E)
-        self.wait_time_entry = tk.Entry(self, width=3)
-        self.wait_time_entry.grid(row=13, column=1, sticky=tk.W)
-        self.wait_time_entry.insert(0, 2.0)
-        self.wait_time_expl_label = tk.Label(self)
-        self.wait_time_expl_label['text'] = '(increase when dist = -1)'
-        self.wait_time_expl_label.grid(row=13, column=2, columnspan=2)
-
-    def spy(self):
-        self.app_main(True)
-
-    def app_main(self, spy=False):
-        self.clear_error()
-        self.output_ST.delete(1.0, tk.END)
-        try:
-            max_speed = float(self.max_speed_entry.get().strip())
-            if max_speed <= 0:
-                raise ValueError
-        except ValueError:
-            self.dest_err_label['text'] = 'invalid max speed'
-            return
-        try:
-            wait_time = float(self.wait_time_entry.get().strip())
-            if wait_time <= 0:
-                raise ValueError
-        except ValueError:
-            self.dest_err_label['text'] = 'invalid wait time'
-            return
-        if not self.valid_filename():
-            self.dest_err_label['text'] = 'invalid filename'
-            return
-        input_dict = {}
-        input_dict[self.dest1_pc_entry.get().strip()] \
-            = self.dest1_dist_entry.get().strip()
-        input_dict[self.dest2_pc_entry.get().strip()] \
-            = self.dest2_dist_entry.get().strip()
-        input_dict[self.dest3_pc_entry.get().strip()] \
-            = self.dest3_dist_entry.get().strip()
-        input_dict[''] = ''
-        del input_dict['']
-        if len(input_dict) == 0:
-            self.dest_err_label['text'] = 'enter destination(s)'
-            return
-        if not set(input_dict.keys()).issubset(pc_set):
-            self.dest_err_label['text'] = 'invalid postcode(s)'
-            return
-        try:
-            for x in input_dict.keys():
-                input_dict[x] = int(input_dict[x])
-        except ValueError:
-            self.dest_err_label['text'] = 'invalid distance(s)'
-            return
-        if min(input_dict.values()) <= 0:
-            self.dest_err_label['text'] = 'invalid distance(s)'
-            return
-        try:
-            pcf = PostcodeFinder(input_dict, max_speed)
-        except SearchAreaError as sae:
-            print(sae)
-            self.dest_err_label['text'] = 'empty search area'
-            return
-        if not spy:
-            pcf.pcf_main(wait_time)
-        output_fname = self.save_entry.get().strip()
-        if output_fname:
-            pc_file = open(output_fname, 'wb')
-            pickle.dump(pcf.get_pc_as_df(), pc_file)
-            pc_file.close()
-            print('Saved dataframe as "' + output_fname + '"')
-        self.output_ST.insert(1.0, pcf.get_pc_as_str() + '\nCount: '
-                              + str(len(pcf.get_pc_as_df())))
-        if self.visualisation_CB_value.get() == 1 and len(pcf.pc) > 0:
-            vis_window = tk.Tk()
-            vis_window.title('Postcodes satisfying the distance requirements')
-            pcv = PostcodeVisualiser(pcf)
-            fig, axs = pcv.vis_main(self)
-            vis_canvas = FigureCanvasTkAgg(fig, master=vis_window)
-            vis_canvas.draw()
-            vis_canvas.get_tk_widget().pack()
-            vis_window.mainloop()
-
-    def clear_error(self):
-        self.dest_err_label['text'] = ''
-
-    def clear_all(self):
-        self.clear_error()
-        self.dest1_pc_entry.delete(0, tk.END)
-        self.dest2_pc_entry.delete(0, tk.END)
-        self.dest3_pc_entry.delete(0, tk.END)
-        self.dest1_dist_entry.delete(0, tk.END)
-        self.dest2_dist_entry.delete(0, tk.END)
-        self.dest3_dist_entry.delete(0, tk.END)
-        self.output_ST.delete(1.0, tk.END)
-
-    def enter_sample(self):
-        self.clear_all()
-        self.dest1_pc_entry.insert(0, 'EX1')
-        self.dest2_pc_entry.insert(0, 'TA1')
-        self.dest1_dist_entry.insert(0, 40)
-        self.dest2_dist_entry.insert(0, 35)
-
-    def valid_filename(self):
-        output_fname = self.save_entry.get().strip()
-        if output_fname == '':
-            return True
-        for c in output_fname:
-            if not any([c.isalpha(), c.isdigit(), c == '_',
-                        c == '-', c == '.']):
-                return False
-        return True
+# table of all UK postcodes with coordinates, its spatial index and the
+# ids of the postcodes, all are loaded on first use by get_pc_raw(),
+# get_pc_index() and get_pc_ids()
+pc_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'postcode-outcodes.csv')
+pc_raw = None
+pc_index = None
+pc_ids = None
+pc_lock = threading.Lock()
+
+
+def get_pc_raw():
+    '''Return the table of all UK postcodes with coordinates.'''
+    global pc_raw, pc_index, pc_ids
+    with pc_lock:
+        if pc_raw is None:
+            table = pd.read_csv(pc_file, index_col='postcode', header=0)
+            pc_ids = table['id'].astype(np.uint16)
+            pc_raw = table.drop(columns=['id'])
+            pc_index = OutcodeIndex(pc_raw)
+    return pc_raw
+
+
+def get_pc_index():
+    '''Return the spatial index of the table of postcodes.'''
+    get_pc_raw()
+    return pc_index
+
+
+def get_pc_ids():
+    '''Return the ids of the postcodes in the table of postcodes (a series
+    indexed by postcode), used in the result files.
+    '''
+    get_pc_raw()
+    return pc_ids
+
+
+# postcode boundary shapes, converted from the shapefiles into the shape
+# cache on first use
+shapes_dir = 'postcode_shapes'
+shape_cache_file = os.path.join(shapes_dir, 'shape_cache.npz')
+shape_tolerances = (0.0, 0.001, 0.005, 0.02)  # simplification in degrees
+shape_cache = None
+
+
+def build_shape_cache():
+    '''Convert the postcode boundary shapefiles into the shape cache.'''
+    import geopandas
+    arrays = {'tolerances': np.array(shape_tolerances)}
+    for layer in ('Areas', 'Districts'):
+        print('Converting shapefile', layer, '...')
+        shapes = geopandas.read_file(os.path.join(shapes_dir, 'Distribution',
+                                                  layer + '.shp'))
+        arrays[layer + '_names'] = np.array([str(x) for x in shapes['name']])
+        arrays[layer + '_bounds'] = shapes.bounds.values
+        for k, tolerance in enumerate(shape_tolerances):
+            geometries = shapes.geometry
+            if tolerance > 0:
+                geometries = geometries.simplify(tolerance)
+            blobs = [g.wkb for g in geometries]
+            arrays['{}_offsets_{}'.format(layer, k)] = \
+                np.cumsum([0] + [len(b) for b in blobs])
+            arrays['{}_wkb_{}'.format(layer, k)] = \
+                np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    np.savez(shape_cache_file, **arrays)
+    print('Saved shape cache as "' + shape_cache_file + '"')
+
+
+def get_shape_cache():
+    '''Return the shape cache, build it first if necessary.'''
+    global shape_cache
+    if shape_cache is None:
+        if not os.path.exists(shape_cache_file):
+            build_shape_cache()
+        shape_cache = ShapeCache(shape_cache_file)
+    return shape_cache
+
 
+# background maps rendered as images by PostcodeVisualiser, keyed by visible
+# area, the least recently used are dropped beyond max_background_images
+background_images = collections.OrderedDict()
+background_lock = threading.Lock()
+max_background_images = 16
 
-# table of all UK postcodes with coordinates
-pc_raw = pd.read_csv('postcode-outcodes.csv',
-                     index_col='postcode', header=0).drop(columns=['id'])
-pc_set = set(pc_raw.index)  # set of valid UK postcodes
 
 # other constants
 figure_size = (6, 6)  # figure size for the geopandas visualisation
+max_labels = 60  # maximum number of postcode labels on the map
+cache_file = 'travel_times.sqlite'  # persistent cache of travel times
+routing_retries = 2  # number of times a failed routing lookup is repeated
+# upper bounds in seconds of the buckets of the latency histograms
+latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0)
+# metrics sinks by format name of the command line
+metrics_sinks = {'jsonl': JSONLinesSink, 'prometheus': PrometheusTextSink}
+batch_chunk_size = 500  # pairs claimed at once by a batch worker
+batch_poll_interval = 30  # s between checks for the other batch workers
+
+
+def matrix_blocks(radius=None, block_size=50):
+    '''Return list of arrays of outcode positions (in the postcode table)
+    with at most block_size outcodes each, covering all outcodes. If radius
+    (in km) is given, the outcodes of a block lie in one square of side
+    radius/2, so that few origins within radius of one outcode of the block
+    are far from the others.
+    '''
+    n = len(get_pc_raw())
+    if radius is None:
+        return [np.arange(k, min(k+block_size, n))
+                for k in range(0, n, block_size)]
+    pc_raw = get_pc_raw()
+    lat = pc_raw.latitude.values
+    # grid of squares of side radius/2 (approximately, 1 degree of latitude
+    # is 111.2 km)
+    side = radius / 2 / 111.2
+    y = np.floor(lat / side).astype(int)
+    x = np.floor(pc_raw.longitude.values * np.cos(np.radians(lat))
+                 / side).astype(int)
+    order = np.lexsort((x, y))
+    cells = np.split(order, np.flatnonzero(
+        (np.diff(y[order]) != 0) | (np.diff(x[order]) != 0)) + 1)
+    return [cell[k:k+block_size] for cell in cells
+            for k in range(0, len(cell), block_size)]
+
+
+def build_travel_matrix(path, backend, radius=None, block_size=50):
+    '''Compute the travel times between all outcodes through the routing
+    backend and store them as a TravelTimeMatrix at path. If radius (in km)
+    is given, only pairs within that as-the-crow-flies distance are computed,
+    the others are left missing. The destinations are processed in blocks of
+    at most block_size (see matrix_blocks), with one travel time matrix per
+    block. The matrix is built in temporary files, which replace an existing
+    matrix at path only once it's complete.
+    '''
+    pc_raw = get_pc_raw()
+    n = len(pc_raw)
+    lat = pc_raw.latitude.values
+    lon = pc_raw.longitude.values
+    minutes = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+',
+                                        dtype=np.uint16, shape=(n, n))
+    minutes[:] = TravelTimeMatrix.MISSING
+    backend.open()
+    done = 0
+    try:
+        for block in matrix_blocks(radius, block_size):
+            if radius is None:
+                origins = np.arange(n)
+            else:
+                origins = np.unique(np.concatenate([
+                    get_pc_index().query_radius(lat[j], lon[j], radius)
+                    for j in block]))
+            rows = backend.travel_time_matrix(
+                list(zip(lat[origins], lon[origins])),
+                list(zip(lat[block], lon[block])))
+            times = np.array(rows, dtype=int).reshape(len(origins),
+                                                      len(block)).T
+            if radius is not None:
+                # origins near one destination of the block may be far from
+                # the others, leave those pairs missing
+                dist = PostcodeFinder.compute_distance(
+                    lat[block][:, np.newaxis], lon[block][:, np.newaxis],
+                    lat[origins], lon[origins])
+                times[dist > radius] = -1
+            times[times < 0] = TravelTimeMatrix.MISSING
+            times = np.minimum(times, TravelTimeMatrix.MISSING)
+            minutes[np.ix_(block, origins)] = times
+            done += len(block)
+            print('Destinations done:', done, 'of', n)
+    finally:
+        backend.close()
+    minutes.flush()
+    del minutes
+    with open(path + '.outcodes.tmp', 'w') as f:
+        f.write('\n'.join(pc_raw.index) + '\n')
+    # the list of outcodes marks a complete matrix: the old one is removed
+    # before the matrix is replaced and the new one is moved in last, so
+    # that the outcodes never go with a matrix being replaced
+    if os.path.exists(path + '.outcodes'):
+        os.remove(path + '.outcodes')
+    os.replace(path + '.tmp.npy', path + '.npy')
+    os.replace(path + '.outcodes.tmp', path + '.outcodes')
+
+
+def load_batch_specs(path):
+    '''Return list of the searches in a batch file, with one JSON object
+    per line, e.g. {"name": "exeter", "destinations": {"EX1": 40,
+    "TA1": 35}, "max_speed": 1.2}. Raises ValueError for invalid searches.
+    '''
+    specs = []
+    names = set()
+    with open(path) as f:
+        for k, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                spec = json.loads(line)
+                name = str(spec['name'])
+                destination_distances = {str(pc).strip(): int(dist) for
+                                         pc, dist in
+                                         spec['destinations'].items()}
+                max_speed = float(spec.get('max_speed', 1.2))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise ValueError('invalid search in line {}'.format(k))
+            if name in names or not valid_search_name(name):
+                raise ValueError('invalid or duplicate name: ' + name)
+            if len(destination_distances) == 0 \
+                    or not set(destination_distances.keys()).issubset(
+                        get_pc_raw().index):
+                raise ValueError('invalid postcode(s) in search ' + name)
+            if min(destination_distances.values()) <= 0 or max_speed <= 0:
+                raise ValueError('invalid distance(s) or max speed in '
+                                 'search ' + name)
+            ResultWriter.check_distances(destination_distances)
+            names.add(name)
+            specs.append((name, destination_distances, max_speed))
+    return specs
+
+
+def valid_search_name(name):
+    '''Check whether name can be used as a file name of the results.'''
+    return len(name) > 0 and not name.startswith('.') \
+        and all(c.isalnum() or c in '-_.' for c in name)
+
+
+def make_batch_finders(specs, travel_matrix=None):
+    '''Return dictionary of the PostcodeFinders of the searches in specs
+    (see load_batch_specs()), keyed by name, None for searches with an
+    empty search area.
+    '''
+    finders = {}
+    # the set-up of thousands of searches would flood the terminal
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for name, destination_distances, max_speed in specs:
+            try:
+                finders[name] = PostcodeFinder(destination_distances,
+                                               max_speed,
+                                               travel_matrix=travel_matrix)
+            except SearchAreaError:
+                finders[name] = None
+    return finders
+
+
+def plan_batch(finders, work_queue, cache=None):
+    '''Add the routing work of the searches (a dictionary of
+    PostcodeFinders, see make_batch_finders()) to work_queue (a WorkQueue).
+    The pairs of origin and destination shared by several searches are
+    routed only once, and pairs in the cache (a TravelTimeCache) are not
+    routed at all.
+    '''
+    total = 0
+    pairs = set()
+    for pcf in finders.values():
+        if pcf is None:
+            continue
+        for p in pcf.pc.index:
+            for d in pcf.destinations:
+                if (p, d) not in pcf.known:
+                    pairs.add((p, d))
+                    total += 1
+    cached = {}
+    if cache is not None:
+        for p, d in pairs:
+            t = cache.get(p, d)
+            if t is not None:
+                cached[(p, d)] = t
+    work_queue.add(sorted(pairs), cached)
+    print('Travel times needed by the searches:', total)
+    print('Unique pairs of origin and destination:', len(pairs))
+    print('Pairs found in the cache:', len(cached))
+
+
+def run_batch_worker(work_queue, backend, chunk_size=None,
+                     retries=routing_retries):
+    '''Claim chunks of pending pairs from work_queue (a WorkQueue) until
+    there are none left, find their travel times using the routing backend
+    and store them in the queue. The pairs of a chunk are requested as one
+    travel time matrix per destination; failed lookups are repeated up to
+    retries times. Returns the number of pairs done.
+    '''
+    if chunk_size is None:
+        chunk_size = batch_chunk_size
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    pc_raw = get_pc_raw()
+    done = 0
+    backend.open()
+    try:
+        while True:
+            chunk = work_queue.claim(worker, chunk_size)
+            if len(chunk) == 0:
+                break
+            by_destination = {}
+            for p, d in chunk:
+                by_destination.setdefault(d, []).append(p)
+            times = {}
+            for d, origins in by_destination.items():
+                dest = (pc_raw.at[d, 'latitude'], pc_raw.at[d, 'longitude'])
+                missing = origins
+                for attempt in range(retries + 1):
+                    coords = [(pc_raw.at[p, 'latitude'],
+                               pc_raw.at[p, 'longitude']) for p in missing]
+                    rows = backend.travel_time_matrix(coords, [dest])
+                    failed = []
+                    for p, row in zip(missing, rows):
+                        times[(p, d)] = row[0]
+                        if row[0] < 0:
+                            failed.append(p)
+                    missing = failed
+                    if len(missing) == 0:
+                        break
+            work_queue.complete(times)
+            done += len(times)
+            print('Pairs done by', worker + ':', done)
+    finally:
+        backend.close()
+    return done
+
+
+def batch_worker_process(queue_path, args):
+    '''Run a batch worker in a process of its own, with the routing backend
+    given by command line arguments.
+    '''
+    work_queue = WorkQueue(queue_path)
+    try:
+        return run_batch_worker(work_queue, make_backend(args),
+                                args.chunk_size, args.retries)
+    finally:
+        work_queue.close()
+
+
+def assemble_batch(finders, work_queue):
+    '''Return dictionary of the tables of postcodes satisfying the distance
+    requirements of the searches, keyed by name, from the travel times in
+    work_queue once all pairs are done. Searches with an empty search area
+    get an empty table. Pairs whose lookups failed every attempt get the
+    travel time -1, as in a single search.
+    '''
+    results = work_queue.results()
+    for pair in work_queue.failed():
+        results[pair] = -1
+    tables = {}
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for name, pcf in finders.items():
+            if pcf is None:
+                tables[name] = get_pc_raw().iloc[0:0]
+                continue
+            for p in pcf.pc.index:
+                for d in pcf.destinations:
+                    if (p, d) in results:
+                        pcf.known[(p, d)] = results[(p, d)]
+            # all travel times are known, the base backend is never opened
+            # or asked
+            pcf.pcf_main(RoutingBackend())
+            tables[name] = pcf.get_pc_as_df()
+    return tables
+
+
+def run_batch(args):
+    '''Run a batch of searches given by command line arguments: plan the
+    routing work, share it between local worker processes and workers on
+    other machines (started with the command batch-worker), wait until it's
+    done and save the result table of every search.
+    '''
+    try:
+        specs = load_batch_specs(args.specs)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    travel_matrix = None
+    if args.travel_matrix:
+        travel_matrix = TravelTimeMatrix(args.travel_matrix)
+    finders = make_batch_finders(specs, travel_matrix)
+    cache = None
+    if args.cache_file:
+        cache = TravelTimeCache(args.cache_file)
+    work_queue = WorkQueue(args.queue)
+    try:
+        # every batch starts with an empty queue, travel times of earlier
+        # batches are reused through the cache only, where they expire
+        work_queue.reset()
+        plan_batch(finders, work_queue, cache)
+        if args.processes > 0:
+            with ProcessPoolExecutor(max_workers=args.processes) as executor:
+                futures = [executor.submit(batch_worker_process, args.queue,
+                                           args)
+                           for k in range(args.processes)]
+                for f in futures:
+                    f.result()
+        # pairs claimed by workers on other machines may still be pending,
+        # take over those whose claims expire
+        while work_queue.pending() > 0:
+            run_batch_worker(work_queue, make_backend(args),
+                             args.chunk_size, args.retries)
+            if work_queue.pending() > 0:
+                print('Waiting for other workers, pending pairs:',
+                      work_queue.pending())
+                time.sleep(batch_poll_interval)
+        tables = assemble_batch(finders, work_queue)
+        if cache is not None:
+            # only the travel times routed in this batch are new, writing
+            # back those taken from the cache would reset their age
+            cache.put_many((p, d, t) for (p, d), t in
+                           work_queue.results(routed_only=True).items())
+    finally:
+        work_queue.close()
+        if cache is not None:
+            cache.close()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, destination_distances, max_speed in specs:
+        with ResultWriter(os.path.join(args.output_dir, name + '.pcr'),
+                          destination_distances, max_speed) as writer:
+            writer.write_table(tables[name])
+        print(name + ':', len(tables[name]), 'postcodes')
+    print('Saved', len(tables), 'result tables in "' + args.output_dir + '"')
+
+
+def run_batch_worker_command(args):
+    '''Work on the queue of a batch started on another machine.'''
+    work_queue = WorkQueue(args.queue)
+    try:
+        run_batch_worker(work_queue, make_backend(args), args.chunk_size,
+                         args.retries)
+    finally:
+        work_queue.close()
+
+
+def run_gui():
+    '''Start the application.'''
+    import tkinter as tk
+    from postcode_finder_gui import Application
+    root = tk.Tk()
+    root.title('Postcode Finder')
+    app = Application(master=root)
+    app.mainloop()
+
+
+def print_result(postcode, times):
+    '''Print a postcode satisfying the requirements as soon as found.'''
+    print('Found:', postcode, '\t', PostcodeFinder.format_times(times))
+
+
+def make_backend(args):
+    '''Return routing backend given by command line arguments.'''
+    if args.engine == 'browser':
+        return SeleniumBackend(args.wait_time, args.max_rate)
+    return OSRMBackend(args.server, pool_size=args.workers,
+                       max_rate=args.max_rate)
+
+
+def add_routing_arguments(parser):
+    '''Add command line arguments of the routing backends to parser.'''
+    parser.add_argument('--engine', choices=['osrm', 'browser'],
+                        default='osrm', help='routing engine')
+    parser.add_argument('--server', default=OSRMBackend().base_url,
+                        help='URL of the OSRM server')
+    parser.add_argument('--wait-time', type=float, default=10.0,
+                        help='maximum browser wait time in seconds')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of parallel requests')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='maximum number of requests per second')
+
+
+def run_search(args):
+    '''Run a search given by command line arguments without the GUI.'''
+    destination_distances = {}
+    for x in args.destinations:
+        pc, sep, dist = x.partition(':')
+        try:
+            destination_distances[pc.strip()] = int(dist)
+        except ValueError:
+            raise SystemExit('invalid destination: ' + x)
+    if not set(destination_distances.keys()).issubset(get_pc_raw().index):
+        raise SystemExit('invalid postcode(s)')
+    if min(destination_distances.values()) <= 0 or args.max_speed <= 0:
+        raise SystemExit('invalid distance(s) or max speed')
+    try:
+        ResultWriter.check_distances(destination_distances)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    backend = make_backend(args)
+    travel_matrix = None
+    if args.travel_matrix:
+        travel_matrix = TravelTimeMatrix(args.travel_matrix)
+    cache = None
+    if args.cache_file:
+        cache = TravelTimeCache(args.cache_file)
+    metrics = None
+    if args.metrics:
+        metrics = Metrics(metrics_sinks[args.metrics_format](args.metrics))
+    writer = None
+    try:
+        pcf = PostcodeFinder(destination_distances, args.max_speed, cache,
+                             travel_matrix, metrics)
+        if args.output:
+            writer = ResultWriter(args.output, destination_distances,
+                                  args.max_speed)
+        if args.spy:
+            if writer is not None:
+                writer.write_table(pcf.get_pc_as_df())
+        else:
+            checkpoint = None
+            if args.checkpoint:
+                checkpoint = Checkpoint(args.checkpoint)
+
+            def on_result(postcode, times):
+                print_result(postcode, times)
+                # results are saved as soon as they are found
+                if writer is not None:
+                    writer.write(postcode, times)
+                    writer.flush()
+
+            pcf.pcf_main(backend, args.matrix, args.workers, args.retries,
+                         checkpoint, args.resume, on_result)
+    except SearchAreaError as sae:
+        raise SystemExit(str(sae))
+    finally:
+        if cache is not None:
+            cache.close()
+        if writer is not None:
+            writer.close()
+            print('Saved results as "' + args.output + '"')
+    print(pcf.get_pc_as_str())
+    print('Count:', len(pcf.get_pc_as_df()))
+
+
+def main(argv=None):
+    '''Command line entry point, starts the GUI if no command is given.'''
+    parser = argparse.ArgumentParser(description='Find UK postcodes within '
+                                     'given driving distances of '
+                                     'destination postcodes.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('gui', help='start the application (default)')
+    search = subparsers.add_parser('search', help='run a search without GUI')
+    search.add_argument('destinations', nargs='+', metavar='POSTCODE:MIN',
+                        help='destination postcode and maximum driving '
+                        'distance in minutes, e.g. EX1:40')
+    search.add_argument('--max-speed', type=float, default=1.2,
+                        help='max speed in km/min (default: 1.2)')
+    add_routing_arguments(search)
+    search.add_argument('--matrix', action='store_true',
+                        help='request travel times as a matrix')
+    search.add_argument('--retries', type=int, default=routing_retries,
+                        help='number of retries of failed lookups')
+    search.add_argument('--travel-matrix', default='',
+                        help='precomputed travel time matrix to use')
+    search.add_argument('--cache-file', default=cache_file,
+                        help='travel time cache, empty string to disable')
+    search.add_argument('--checkpoint', default='',
+                        help='record travel times in this checkpoint file')
+    search.add_argument('--resume', action='store_true',
+                        help='resume search from the checkpoint file')
+    search.add_argument('--output', default='',
+                        help='save results to this file')
+    search.add_argument('--metrics', default='',
+                        help='write metrics of the search to this file')
+    search.add_argument('--metrics-format', choices=sorted(metrics_sinks),
+                        default='jsonl', help='format of the metrics file: '
+                        'JSON lines (appended) or Prometheus text')
+    search.add_argument('--spy', action='store_true',
+                        help='only determine the search area')
+    build = subparsers.add_parser('build-matrix', help='precompute the '
+                                  'travel times between all outcodes')
+    build.add_argument('path', help='path of the matrix, without extension')
+    build.add_argument('--radius', type=float, default=None,
+                       help='only compute pairs within this distance in km')
+    add_routing_arguments(build)
+    batch = subparsers.add_parser('batch', help='run a batch of searches')
+    batch.add_argument('specs', help='file of searches, one JSON object per '
+                       'line with name, destinations and max_speed')
+    batch.add_argument('--queue', default='batch_queue.sqlite',
+                       help='work queue shared with the batch workers')
+    batch.add_argument('--processes', type=int, default=4,
+                       help='number of local worker processes, 0 to route '
+                       'in the main process only')
+    batch.add_argument('--output-dir', default='batch_results',
+                       help='directory of the result tables')
+    batch.add_argument('--travel-matrix', default='',
+                       help='precomputed travel time matrix to use')
+    batch.add_argument('--cache-file', default=cache_file,
+                       help='travel time cache, empty string to disable')
+    worker = subparsers.add_parser('batch-worker', help='work on the queue '
+                                   'of a batch started elsewhere')
+    worker.add_argument('queue', help='work queue of the batch')
+    for p in (batch, worker):
+        add_routing_arguments(p)
+        p.add_argument('--chunk-size', type=int, default=batch_chunk_size,
+                       help='pairs claimed at once')
+        p.add_argument('--retries', type=int, default=routing_retries,
+                       help='number of retries of failed lookups')
+    subparsers.add_parser('build-shapes', help='convert the postcode '
+                          'shapefiles into the shape cache for the map')
+    args = parser.parse_args(argv)
+    if args.command == 'search':
+        run_search(args)
+    elif args.command == 'build-matrix':
+        build_travel_matrix(args.path, make_backend(args), args.radius)
+    elif args.command == 'batch':
+        run_batch(args)
+    elif args.command == 'batch-worker':
+        run_batch_worker_command(args)
+    elif args.command == 'build-shapes':
+        build_shape_cache()
+    else:
+        run_gui()
+
 
-# start the application
-root = tk.Tk()
-root.title('Postcode Finder')
-app = Application(master=root)
-app.mainloop()
+if __name__ == '__main__':
+    main()
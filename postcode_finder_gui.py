@@ -0,0 +1,406 @@
+# POSTCODE FINDER APPLICATION
+# AUTHOR: Pascal Philipp
+
+# The Tk application of the postcode finder, started by
+# postcode_finder.run_gui(). It's kept apart from the search engine in
+# postcode_finder, which can then be imported without tkinter.
+
+import queue
+import threading
+import traceback
+import tkinter as tk
+import tkinter.scrolledtext as tkst
+import tkinter.ttk as ttk
+
+from postcode_finder import Checkpoint, OSRMBackend, PostcodeFinder, \
+    PostcodeVisualiser, ResultWriter, SearchAreaError, SeleniumBackend, \
+    TravelTimeCache, get_pc_raw, cache_file, routing_retries
+
+
+class Application(tk.Frame):
+    def __init__(self, master=None):
+        super().__init__(master)
+        self.pack()
+        self.create_widgets()
+
+    def create_widgets(self):
+
+        self.info_label = tk.Label(self)
+        self.info_label['text'] = 'Enter destination postcode ' \
+                                  + 'and maximum distance'
+        self.info_label.grid(row=0, column=0, columnspan=4)
+
+        self.dest1_label = tk.Label(self, text='Destination 1 ')
+        self.dest1_label.grid(row=1, column=0, sticky=tk.E)
+        self.dest2_label = tk.Label(self, text='Destination 2 ')
+        self.dest2_label.grid(row=2, column=0, sticky=tk.E)
+        self.dest3_label = tk.Label(self, text='Destination 3 ')
+        self.dest3_label.grid(row=3, column=0, sticky=tk.E)
+        self.dest1_pc_entry = tk.Entry(self, width=4)
+        self.dest1_pc_entry.grid(row=1, column=1)
+        self.dest2_pc_entry = tk.Entry(self, width=4)
+        self.dest2_pc_entry.grid(row=2, column=1)
+        self.dest3_pc_entry = tk.Entry(self, width=4)
+        self.dest3_pc_entry.grid(row=3, column=1)
+        self.dest1_dist_entry = tk.Entry(self, width=3)
+        self.dest1_dist_entry.grid(row=1, column=2)
+        self.dest2_dist_entry = tk.Entry(self, width=3)
+        self.dest2_dist_entry.grid(row=2, column=2)
+        self.dest3_dist_entry = tk.Entry(self, width=3)
+        self.dest3_dist_entry.grid(row=3, column=2)
+
+        self.dest_err_label = tk.Label(self, fg='red')
+        self.dest_err_label.grid(row=3, column=3)
+
+        self.sample_search_button = tk.Button(self)
+        self.sample_search_button['text'] = 'Sample search'
+        self.sample_search_button['command'] = self.enter_sample
+        self.sample_search_button.grid(row=4, column=0)
+
+        self.clear_button = tk.Button(self)
+        self.clear_button['text'] = 'Clear'
+        self.clear_button['command'] = self.clear_all
+        self.clear_button.grid(row=4, column=3, ipadx=32)
+
+        self.find_postcodes_button = tk.Button(self)
+        self.find_postcodes_button['text'] = 'Find postcodes'
+        self.find_postcodes_button['command'] = self.app_main
+        self.find_postcodes_button.grid(row=5, column=3, padx=10)
+
+        self.cancel_button = tk.Button(self)
+        self.cancel_button['text'] = 'Cancel'
+        self.cancel_button['command'] = self.cancel_search
+        self.cancel_button['state'] = tk.DISABLED
+        self.cancel_button.grid(row=5, column=2)
+
+        self.progress_bar = ttk.Progressbar(self, length=120,
+                                            mode='determinate')
+        self.progress_bar.grid(row=4, column=1, columnspan=2)
+
+        self.visualisation_label = tk.Label(self, text='Draw map')
+        self.visualisation_label.grid(row=5, column=0, sticky=tk.E)
+        self.visualisation_CB = tk.Checkbutton(self)
+        self.visualisation_CB_value = tk.IntVar()
+        self.visualisation_CB['variable'] = self.visualisation_CB_value
+        self.visualisation_CB.grid(row=5, column=1, sticky=tk.W)
+
+        self.output_ST = tkst.ScrolledText(self, width=48)
+        self.output_ST.grid(row=6, column=0, columnspan=4)
+
+        self.search_settings_label = tk.Label(self)
+        self.search_settings_label['text'] = '-- Search settings --'
+        self.search_settings_label.grid(row=7, column=0, columnspan=4)
+        self.max_speed_label = tk.Label(self, text='Max speed in km/min')
+        self.max_speed_label.grid(row=8, column=0, sticky=tk.E)
+        self.max_speed_entry = tk.Entry(self, width=3)
+        self.max_speed_entry.grid(row=8, column=1, columnspan=2, sticky=tk.W)
+        self.max_speed_entry.insert(0, 1.2)
+        self.spy_button = tk.Button(self)
+        self.spy_button['text'] = 'Spy search area'
+        self.spy_button['command'] = self.spy
+        self.spy_button.grid(row=8, column=3)
+
+        self.map_settings_label = tk.Label(self)
+        self.map_settings_label['text'] = '-- Map settings --'
+        self.map_settings_label.grid(row=9, column=0, columnspan=4)
+        self.pc_labels_label = tk.Label(self, text='Label postcodes')
+        self.pc_labels_label.grid(row=10, column=0, sticky=tk.E)
+        self.pc_labels_CB = tk.Checkbutton(self)
+        self.pc_labels_CB_value = tk.IntVar()
+        self.pc_labels_CB['variable'] = self.pc_labels_CB_value
+        self.pc_labels_CB.grid(row=10, column=1, sticky=tk.W)
+        self.draw_search_area_label = tk.Label(self, text='Draw search area')
+        self.draw_search_area_label.grid(row=10, column=3, sticky=tk.W)
+        self.draw_search_area_CB = tk.Checkbutton(self)
+        self.draw_search_area_CB_value = tk.IntVar()
+        self.draw_search_area_CB['variable'] = self.draw_search_area_CB_value
+        self.draw_search_area_CB.grid(row=10, column=2, sticky=tk.E)
+
+        self.technical_settings_label = tk.Label(self)
+        self.technical_settings_label['text'] = '-- Other settings --'
+        self.technical_settings_label.grid(row=11, column=0, columnspan=4)
+        self.save_label = tk.Label(self, text='Save results as')
+        self.save_label.grid(row=12, column=0, sticky=tk.E)
+        self.save_entry = tk.Entry(self, width=8)
+        self.save_entry.grid(row=12, column=1, columnspan=2, sticky=tk.W)
+        self.wait_time_label = tk.Label(self, text='Max browser wait')
+        self.wait_time_label.grid(row=13, column=0, sticky=tk.E)
+        self.wait_time_entry = tk.Entry(self, width=3)
+        self.wait_time_entry.grid(row=13, column=1, sticky=tk.W)
+        self.wait_time_entry.insert(0, 10.0)
+        self.wait_time_expl_label = tk.Label(self)
+        self.wait_time_expl_label['text'] = '(increase when dist = -1)'
+        self.wait_time_expl_label.grid(row=13, column=2, columnspan=2)
+        self.routing_engine_label = tk.Label(self, text='Routing engine')
+        self.routing_engine_label.grid(row=14, column=0, sticky=tk.E)
+        self.routing_engine_value = tk.StringVar()
+        self.routing_engine_value.set('OSRM API')
+        self.routing_engine_OM = tk.OptionMenu(self,
+                                               self.routing_engine_value,
+                                               'OSRM API', 'Browser')
+        self.routing_engine_OM.grid(row=14, column=1, columnspan=2,
+                                    sticky=tk.W)
+        self.routing_server_label = tk.Label(self, text='OSRM server')
+        self.routing_server_label.grid(row=15, column=0, sticky=tk.E)
+        self.routing_server_entry = tk.Entry(self, width=32)
+        self.routing_server_entry.grid(row=15, column=1, columnspan=3,
+                                       sticky=tk.W)
+        self.routing_server_entry.insert(0, OSRMBackend().base_url)
+        self.matrix_label = tk.Label(self, text='Matrix requests')
+        self.matrix_label.grid(row=16, column=0, sticky=tk.E)
+        self.matrix_CB = tk.Checkbutton(self)
+        self.matrix_CB_value = tk.IntVar()
+        self.matrix_CB['variable'] = self.matrix_CB_value
+        self.matrix_CB.grid(row=16, column=1, sticky=tk.W)
+        self.matrix_CB.select()
+        self.cache_label = tk.Label(self, text='Cache travel times')
+        self.cache_label.grid(row=16, column=3, sticky=tk.W)
+        self.cache_CB = tk.Checkbutton(self)
+        self.cache_CB_value = tk.IntVar()
+        self.cache_CB['variable'] = self.cache_CB_value
+        self.cache_CB.grid(row=16, column=2, sticky=tk.E)
+        self.cache_CB.select()
+        self.workers_label = tk.Label(self, text='Parallel requests')
+        self.workers_label.grid(row=17, column=0, sticky=tk.E)
+        self.workers_entry = tk.Entry(self, width=3)
+        self.workers_entry.grid(row=17, column=1, sticky=tk.W)
+        self.workers_entry.insert(0, 4)
+        self.checkpoint_label = tk.Label(self, text='Checkpoint file')
+        self.checkpoint_label.grid(row=18, column=0, sticky=tk.E)
+        self.checkpoint_entry = tk.Entry(self, width=8)
+        self.checkpoint_entry.grid(row=18, column=1, columnspan=2,
+                                   sticky=tk.W)
+        self.resume_label = tk.Label(self, text='Resume')
+        self.resume_label.grid(row=18, column=3, sticky=tk.W)
+        self.resume_CB = tk.Checkbutton(self)
+        self.resume_CB_value = tk.IntVar()
+        self.resume_CB['variable'] = self.resume_CB_value
+        self.resume_CB.grid(row=18, column=2, sticky=tk.E)
+
+    def spy(self):
+        self.app_main(True)
+
+    def app_main(self, spy=False):
+        self.clear_error()
+        self.output_ST.delete(1.0, tk.END)
+        try:
+            max_speed = float(self.max_speed_entry.get().strip())
+            if max_speed <= 0:
+                raise ValueError
+        except ValueError:
+            self.dest_err_label['text'] = 'invalid max speed'
+            return
+        try:
+            wait_time = float(self.wait_time_entry.get().strip())
+            if wait_time <= 0:
+                raise ValueError
+        except ValueError:
+            self.dest_err_label['text'] = 'invalid wait time'
+            return
+        try:
+            workers = int(self.workers_entry.get().strip())
+            if workers <= 0:
+                raise ValueError
+        except ValueError:
+            self.dest_err_label['text'] = 'invalid parallel requests'
+            return
+        if self.routing_engine_value.get() == 'Browser':
+            backend = SeleniumBackend(wait_time)
+        else:
+            server = self.routing_server_entry.get().strip()
+            if not server.startswith(('http://', 'https://')):
+                self.dest_err_label['text'] = 'invalid OSRM server'
+                return
+            backend = OSRMBackend(server, pool_size=workers)
+        if not self.valid_filename(self.save_entry.get().strip()):
+            self.dest_err_label['text'] = 'invalid filename'
+            return
+        checkpoint = None
+        checkpoint_fname = self.checkpoint_entry.get().strip()
+        if not self.valid_filename(checkpoint_fname):
+            self.dest_err_label['text'] = 'invalid checkpoint file'
+            return
+        if checkpoint_fname:
+            checkpoint = Checkpoint(checkpoint_fname)
+        input_dict = {}
+        input_dict[self.dest1_pc_entry.get().strip()] \
+            = self.dest1_dist_entry.get().strip()
+        input_dict[self.dest2_pc_entry.get().strip()] \
+            = self.dest2_dist_entry.get().strip()
+        input_dict[self.dest3_pc_entry.get().strip()] \
+            = self.dest3_dist_entry.get().strip()
+        input_dict[''] = ''
+        del input_dict['']
+        if len(input_dict) == 0:
+            self.dest_err_label['text'] = 'enter destination(s)'
+            return
+        if not set(input_dict.keys()).issubset(get_pc_raw().index):
+            self.dest_err_label['text'] = 'invalid postcode(s)'
+            return
+        try:
+            for x in input_dict.keys():
+                input_dict[x] = int(input_dict[x])
+        except ValueError:
+            self.dest_err_label['text'] = 'invalid distance(s)'
+            return
+        if min(input_dict.values()) <= 0:
+            self.dest_err_label['text'] = 'invalid distance(s)'
+            return
+        try:
+            ResultWriter.check_distances(input_dict)
+        except ValueError:
+            self.dest_err_label['text'] = 'distance(s) too large'
+            return
+        cache = None
+        if self.cache_CB_value.get() == 1:
+            cache = TravelTimeCache(cache_file)
+        try:
+            pcf = PostcodeFinder(input_dict, max_speed, cache)
+        except SearchAreaError as sae:
+            print(sae)
+            self.dest_err_label['text'] = 'empty search area'
+            if cache is not None:
+                cache.close()
+            return
+        if spy:
+            if cache is not None:
+                cache.close()
+            self.show_search(pcf)
+            return
+        # run the search in a background thread, which reports back through
+        # the message queue polled in poll_messages()
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.find_postcodes_button['state'] = tk.DISABLED
+        self.spy_button['state'] = tk.DISABLED
+        self.cancel_button['state'] = tk.NORMAL
+        self.progress_bar['value'] = 0
+        # Tk variables must only be read in the main thread
+        search_args = (backend, self.matrix_CB_value.get() == 1, workers,
+                       routing_retries, checkpoint,
+                       self.resume_CB_value.get() == 1)
+        worker = threading.Thread(target=self.search_worker,
+                                  args=(pcf, search_args, cache),
+                                  daemon=True)
+        worker.start()
+        self.after(poll_interval, self.poll_messages)
+
+    def search_worker(self, pcf, search_args, cache):
+        '''Run the search with the given arguments of pcf_main(), called in
+        a background thread. Results and progress are passed to the main
+        thread through the message queue.
+        '''
+
+        def on_result(p, times):
+            self.messages.put(('result', p, times))
+
+        def on_progress(done, total):
+            self.messages.put(('progress', done, total))
+
+        try:
+            pcf.pcf_main(*search_args, on_result=on_result,
+                         on_progress=on_progress, cancel=self.cancel_event)
+            self.messages.put(('done', pcf))
+        except Exception:
+            traceback.print_exc()
+            self.messages.put(('error', pcf))
+        finally:
+            if cache is not None:
+                cache.close()
+
+    def poll_messages(self):
+        '''Process the messages of the search worker, called regularly by
+        the Tk main loop while a search is running.
+        '''
+        try:
+            while True:
+                message = self.messages.get_nowait()
+                if message[0] == 'result':
+                    self.show_result(message[1], message[2])
+                elif message[0] == 'progress':
+                    self.progress_bar['maximum'] = message[2]
+                    self.progress_bar['value'] = message[1]
+                else:
+                    self.find_postcodes_button['state'] = tk.NORMAL
+                    self.spy_button['state'] = tk.NORMAL
+                    self.cancel_button['state'] = tk.DISABLED
+                    if message[0] == 'error':
+                        self.dest_err_label['text'] = 'search failed'
+                        return
+                    if message[1].cancelled:
+                        self.dest_err_label['text'] = 'search cancelled'
+                    self.show_search(message[1])
+                    return
+        except queue.Empty:
+            pass
+        self.after(poll_interval, self.poll_messages)
+
+    def cancel_search(self):
+        '''Stop the running search, outstanding lookups are abandoned.'''
+        self.cancel_event.set()
+        self.cancel_button['state'] = tk.DISABLED
+
+    def show_search(self, pcf):
+        '''Save and display the table of postcodes found by a search.'''
+        # the table is shown first, so that it's not lost if saving fails
+        self.output_ST.delete(1.0, tk.END)
+        self.output_ST.insert(1.0, pcf.get_pc_as_str() + '\nCount: '
+                              + str(len(pcf.get_pc_as_df())))
+        output_fname = self.save_entry.get().strip()
+        if output_fname:
+            try:
+                with ResultWriter(output_fname, pcf.destination_distances,
+                                  pcf.max_speed) as writer:
+                    writer.write_table(pcf.get_pc_as_df())
+                print('Saved results as "' + output_fname + '"')
+            except (ValueError, OSError) as e:
+                self.dest_err_label['text'] = 'results not saved'
+                print('Results not saved:', e)
+        if self.visualisation_CB_value.get() == 1 and len(pcf.pc) > 0:
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            vis_window = tk.Toplevel(self)
+            vis_window.title('Postcodes satisfying the distance requirements')
+            pcv = PostcodeVisualiser(pcf)
+            fig, axs = pcv.vis_main(self)
+            vis_canvas = FigureCanvasTkAgg(fig, master=vis_window)
+            vis_canvas.draw()
+            vis_canvas.get_tk_widget().pack()
+
+    def show_result(self, postcode, times):
+        '''Append a postcode satisfying the requirements to the output.'''
+        self.output_ST.insert(tk.END, postcode + '\t'
+                              + PostcodeFinder.format_times(times) + '\n')
+        self.output_ST.see(tk.END)
+
+    def clear_error(self):
+        self.dest_err_label['text'] = ''
+
+    def clear_all(self):
+        self.clear_error()
+        self.dest1_pc_entry.delete(0, tk.END)
+        self.dest2_pc_entry.delete(0, tk.END)
+        self.dest3_pc_entry.delete(0, tk.END)
+        self.dest1_dist_entry.delete(0, tk.END)
+        self.dest2_dist_entry.delete(0, tk.END)
+        self.dest3_dist_entry.delete(0, tk.END)
+        self.output_ST.delete(1.0, tk.END)
+
+    def enter_sample(self):
+        self.clear_all()
+        self.dest1_pc_entry.insert(0, 'EX1')
+        self.dest2_pc_entry.insert(0, 'TA1')
+        self.dest1_dist_entry.insert(0, 40)
+        self.dest2_dist_entry.insert(0, 35)
+
+    def valid_filename(self, output_fname):
+        if output_fname == '':
+            return True
+        for c in output_fname:
+            if not any([c.isalpha(), c.isdigit(), c == '_',
+                        c == '-', c == '.']):
+                return False
+        return True
+
+
+# other constants
+poll_interval = 100  # ms between checks for messages of the search worker
@@ -0,0 +1,267 @@
+# POSTCODE FINDER TESTS
+# AUTHOR: Pascal Philipp
+
+# Tests of the routing backends, result files and batch work queue, which
+# run offline against the fakes of benchmark.py.
+#
+# Usage: python -m unittest test_postcode_finder
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import benchmark
+import postcode_finder as pf
+
+
+class RecordingOSRMHandler(benchmark.FakeOSRMHandler):
+    '''Handler of the fake OSRM server that records every request and lets
+    the test change the answers through the edit function of the server,
+    which is given the number of the request and the JSON data.
+    '''
+
+    def answer(self, service, points, query):
+        data = super().answer(service, points, query)
+        self.server.requests.append((service, points, query))
+        return self.server.edit(len(self.server.requests), data)
+
+
+class OSRMBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = benchmark.FakeRoutingBackend()
+        self.server = benchmark.FakeOSRMServer(self.fake,
+                                               RecordingOSRMHandler)
+        self.server.requests = []
+        self.server.edit = lambda k, data: data
+        self.server.__enter__()
+        self.backend = pf.OSRMBackend(base_url=self.server.url,
+                                      max_table_size=5)
+        self.origins = [(50.7 + 0.1*i, -3.5 + 0.1*i) for i in range(7)]
+        self.destinations = [(51.0, -3.1), (50.4, -4.1)]
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.__exit__(None, None, None)
+
+    def expected(self, origins, destinations):
+        return [[self.fake.minutes(o[0], o[1], d[0], d[1])
+                 for d in destinations] for o in origins]
+
+    def test_route(self):
+        o, d = self.origins[0], self.destinations[0]
+        self.assertEqual(self.backend.travel_time(o[0], o[1], d[0], d[1]),
+                         self.fake.minutes(o[0], o[1], d[0], d[1]))
+
+    def test_route_not_found(self):
+        self.server.edit = lambda k, data: {'code': 'NoRoute', 'routes': []}
+        o, d = self.origins[0], self.destinations[0]
+        self.assertEqual(self.backend.travel_time(o[0], o[1], d[0], d[1]),
+                         -1)
+
+    def test_server_unreachable(self):
+        self.backend.base_url = 'http://127.0.0.1:1'
+        o, d = self.origins[0], self.destinations[0]
+        self.assertEqual(self.backend.travel_time(o[0], o[1], d[0], d[1]),
+                         -1)
+        self.assertEqual(self.backend.travel_time_matrix(self.origins[:2],
+                                                         self.destinations),
+                         [[-1, -1], [-1, -1]])
+
+    def test_table_chunks(self):
+        rows = self.backend.travel_time_matrix(self.origins,
+                                               self.destinations)
+        self.assertEqual(rows, self.expected(self.origins,
+                                             self.destinations))
+        # 3 origins and the 2 destinations fit into a request of 5
+        # coordinates
+        requests = self.server.requests
+        self.assertEqual(len(requests), 3)
+        for (service, points, query), k in zip(requests, [0, 3, 6]):
+            chunk = self.origins[k:k+3]
+            n = len(chunk)
+            self.assertEqual(service, 'table')
+            self.assertEqual(query['sources'],
+                             [';'.join(str(i) for i in range(n))])
+            self.assertEqual(query['destinations'],
+                             [';'.join(str(n+j) for j in range(2))])
+            self.assertEqual([(round(lat, 4), round(lon, 4))
+                              for lat, lon in points],
+                             [(round(lat, 4), round(lon, 4))
+                              for lat, lon in chunk + self.destinations])
+
+    def test_table_chunk_failed(self):
+        # the second chunk fails, only its travel times are missing
+        self.server.edit = lambda k, data: \
+            {'code': 'NoTable'} if k == 2 else data
+        rows = self.backend.travel_time_matrix(self.origins,
+                                               self.destinations)
+        expected = self.expected(self.origins, self.destinations)
+        expected[3:6] = [[-1, -1]] * 3
+        self.assertEqual(rows, expected)
+
+    def test_table_null_durations(self):
+        def edit(k, data):
+            data['durations'][1][0] = None
+            return data
+        self.server.edit = edit
+        rows = self.backend.travel_time_matrix(self.origins[:3],
+                                               self.destinations)
+        expected = self.expected(self.origins[:3], self.destinations)
+        expected[1][0] = -1
+        self.assertEqual(rows, expected)
+
+    def test_table_cancelled(self):
+        # chunks after cancel are not requested, their travel times are
+        # None rather than failed
+        cancel = threading.Event()
+        self.server.edit = lambda k, data: cancel.set() or data
+        rows = self.backend.travel_time_matrix(self.origins,
+                                               self.destinations, cancel)
+        expected = self.expected(self.origins[:3], self.destinations)
+        self.assertEqual(rows, expected + [[None, None]] * 4)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class ResultFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'search.pcr')
+        self.destination_distances = {'EX1': 40, 'TA1': 35}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, append=False, **kwargs):
+        args = dict(destination_distances=self.destination_distances,
+                    max_speed=1.2)
+        args.update(kwargs)
+        return pf.ResultWriter(self.path, append=append, **args)
+
+    def test_round_trip(self):
+        pc = pf.get_pc_raw().loc[['EX2', 'EX4']].copy()
+        pc['EX1'] = [12, 70000]
+        pc['TA1'] = [30, -1]
+        with self.write() as w:
+            w.write('EX1', {'EX1': 0, 'TA1': 33})
+            w.write_table(pc)
+        f = pf.ResultFile(self.path)
+        self.assertEqual(f.max_speed, 1.2)
+        self.assertEqual(f.destination_distances(),
+                         self.destination_distances)
+        records = f.records()
+        self.assertEqual(list(records['id']),
+                         list(pf.get_pc_ids()[['EX1', 'EX2', 'EX4']]))
+        # travel times not found are MISSING, too long ones are capped
+        self.assertEqual(records['minutes'].tolist(),
+                         [[0, 33], [12, 30],
+                          [pf.ResultFile.MISSING - 1, pf.ResultFile.MISSING]])
+        df = f.to_df()
+        self.assertEqual(list(df.index), ['EX1', 'EX2', 'EX4'])
+        self.assertEqual(df['TA1'].tolist(), [33, 30, -1])
+        self.assertEqual(df.latitude.tolist(),
+                         pf.get_pc_raw().latitude[df.index].tolist())
+
+    def test_truncated_record(self):
+        with self.write() as w:
+            w.write('EX1', {'EX1': 5, 'TA1': 33})
+            w.write('EX2', {'EX1': 7, 'TA1': 30})
+        size = os.path.getsize(self.path)
+        # a crash left part of a third record
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        self.assertEqual(len(pf.ResultFile(self.path).records()), 2)
+        # appending cuts off the incomplete record
+        with self.write(append=True) as w:
+            w.write('EX4', {'EX1': 9})
+        records = pf.ResultFile(self.path).records()
+        self.assertEqual(os.path.getsize(self.path),
+                         size + records.dtype.itemsize)
+        self.assertEqual(list(records['id']),
+                         list(pf.get_pc_ids()[['EX1', 'EX2', 'EX4']]))
+        self.assertEqual(records['minutes'][2].tolist(),
+                         [9, pf.ResultFile.MISSING])
+
+    def test_append_other_search(self):
+        self.write().close()
+        with self.assertRaises(ValueError):
+            self.write(append=True, max_speed=1.5)
+        with self.assertRaises(ValueError):
+            self.write(append=True,
+                       destination_distances={'EX1': 40, 'TA1': 36})
+        with self.assertRaises(ValueError):
+            self.write(append=True, destination_distances={'EX1': 40})
+        # the existing file is left as it was
+        self.assertEqual(pf.ResultFile(self.path).destination_distances(),
+                         self.destination_distances)
+
+    def test_invalid_files(self):
+        with self.assertRaises(ValueError):
+            self.write(destination_distances={'EX1': 70000})
+        with open(self.path, 'wb') as f:
+            f.write(b'postcode,EX1\n')
+        with self.assertRaises(ValueError):
+            pf.ResultFile(self.path)
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'queue.sqlite')
+        self.queue = pf.WorkQueue(self.path)
+        self.pairs = [('EX2', 'TA1'), ('EX2', 'EX1'), ('EX4', 'EX1')]
+        self.queue.add(self.pairs, {('EX4', 'EX1'): 8})
+
+    def tearDown(self):
+        self.queue.close()
+        self.dir.cleanup()
+
+    def test_claim_and_complete(self):
+        self.assertEqual(self.queue.pending(), 2)
+        self.assertEqual(self.queue.claim('a', 10),
+                         [('EX2', 'EX1'), ('EX2', 'TA1')])
+        # claimed pairs are not given to another worker
+        self.assertEqual(self.queue.claim('b', 10), [])
+        self.queue.complete({('EX2', 'EX1'): 9, ('EX2', 'TA1'): 31})
+        self.assertEqual(self.queue.pending(), 0)
+        self.assertEqual(self.queue.results(),
+                         {('EX2', 'EX1'): 9, ('EX2', 'TA1'): 31,
+                          ('EX4', 'EX1'): 8})
+        self.assertEqual(self.queue.results(routed_only=True),
+                         {('EX2', 'EX1'): 9, ('EX2', 'TA1'): 31})
+
+    def test_lease_expiry(self):
+        self.assertEqual(len(self.queue.claim('a', 1)), 1)
+        # the claim of worker a expires, another worker takes the pair over
+        other = pf.WorkQueue(self.path, lease=0.05)
+        try:
+            self.assertEqual(other.claim('b', 10), [('EX2', 'TA1')])
+            time.sleep(0.1)
+            self.assertEqual(other.claim('b', 10),
+                             [('EX2', 'EX1'), ('EX2', 'TA1')])
+        finally:
+            other.close()
+
+    def test_max_attempts(self):
+        for k in range(self.queue.max_attempts):
+            self.assertEqual(self.queue.failed(), [])
+            # a failed lookup releases the pair for the next claim
+            self.assertEqual(self.queue.claim('a', 1), [('EX2', 'EX1')])
+            self.queue.complete({('EX2', 'EX1'): -1})
+        self.assertEqual(self.queue.failed(), [('EX2', 'EX1')])
+        self.assertEqual(self.queue.pending(), 1)
+        self.assertEqual(self.queue.claim('a', 10), [('EX2', 'TA1')])
+        self.assertNotIn(('EX2', 'EX1'), self.queue.results())
+
+    def test_reset(self):
+        self.queue.reset()
+        self.assertEqual(self.queue.pending(), 0)
+        self.assertEqual(self.queue.results(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()